@@ -1,13 +1,22 @@
-from fastapi import FastAPI, HTTPException
+import startup
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
-from langchain.vectorstores import FAISS
 from fastapi.middleware.cors import CORSMiddleware
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.schema import Document
-import requests
 import os
 from dotenv import load_dotenv
-import uvicorn
+from backends import get_embeddings
+from embedding_cache import CachedEmbeddings
+from vector_stores import journey_index_from_env
+from journey_index import journey_documents, normalize
+from lexical import CONFIDENT_PATHS, FUSION_CANDIDATES, LEXICAL_MATCH, LexicalMatcher, fuse_scores
+from async_utils import close_http_client, run_blocking
+import metrics
+import methods_api
+import catalog_registry
+from metrics import count_match_path, stage
+from catalog import Catalog, OPENSHEET_JOURNEYS_URL, OPENSHEET_METHODS_URL
+from bundle import load_bundle, seed_from_bundle
+from catalog_registry import DEFAULT_CATALOG, CatalogEntry, CatalogRegistry
 
 app = FastAPI()
 app.add_middleware(
@@ -18,95 +27,195 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+metrics.install_fastapi(app, 'FAISS_test')
 load_dotenv()
 
-FAISS_INDEX_FILE = '/tmp/faiss_index.bin'
+FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", '/tmp/faiss_index.bin')
 
-def save_faiss_index(db):
-    db.save_local(FAISS_INDEX_FILE)
+catalog = Catalog(OPENSHEET_JOURNEYS_URL, OPENSHEET_METHODS_URL)
+embeddings = CachedEmbeddings(get_embeddings())
+# Persisted FAISS journey index unless VECTOR_STORE selects another store
+journey_index = journey_index_from_env(FAISS_INDEX_PATH, embeddings)
+# Prebuilt catalog and index from `python bundle.py --source opensheet`, if present
+with startup.phase("bundle"):
+    bundle = load_bundle('opensheet', embeddings, OPENSHEET_JOURNEYS_URL, OPENSHEET_METHODS_URL)
+seed_from_bundle(bundle, catalog, journey_index)
+lexical_matcher = LexicalMatcher()
+# The opensheet pair above is the default catalog; CATALOGS adds client catalogs, each
+# with its own sheets, tables and index, loaded on first use
+registry = CatalogRegistry(CatalogEntry(DEFAULT_CATALOG, catalog, journey_index, lexical_matcher),
+                           embeddings, FAISS_INDEX_PATH)
 
-def load_faiss_index_if_exists(embeddings):
-    if os.path.exists(FAISS_INDEX_FILE):
-        return FAISS.load_local(FAISS_INDEX_FILE, embeddings)
-    return None
 
-def load_data_from_url(url):
-    response = requests.get(url)
-    response.raise_for_status()
-    return response.json()
+# Upper bound on inputs accepted by /find_closest_match/batch
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
 
 
 @app.post("/find_closest_match")
-async def find_closest_match(payload: dict):
+async def find_closest_match(payload: dict, request: Request):
     user_input = payload.get("user_input")
     if not user_input:
         raise HTTPException(status_code=400, detail="User input is required in the payload")
-
-    # Load the JSON from the provided URL
-    json_url = "https://opensheet.elk.sh/1vgJJHgyIrjip-6Z-yCW6caMgrZpJo1-waucKqvfg1HI/5"
-    data = load_data_from_url(json_url)
-    #   
-    agenda_items = [item.get('Journey Name (N)', 'Default Description') for item in data]
-
-    # Initialize embeddings and check if FAISS index exists
-    embeddings = OpenAIEmbeddings()
-    faiss_index = load_faiss_index_if_exists(embeddings)
-    if faiss_index is None:
-        # Create a new index and save it
-        documents = [Document(page_content=item) for item in agenda_items]
-        faiss_index = FAISS.from_documents(documents, embeddings)
-        save_faiss_index(faiss_index)
-    # Find the closest match
-    similar_docs = faiss_index.similarity_search(user_input, k=1)
+    entry = registry.resolve(payload, request.headers)
+
+    # Journey and methods sheets come from the in-memory catalog
+    snapshot = await entry.catalog.aget()
+
+    # Journey names typed (almost) verbatim are answered locally, without an embedding call
+    path, lexical_matches = 'vector', []
+    if LEXICAL_MATCH:
+        lexical_index = await entry.lexical.aget(snapshot)
+        with stage("lexical_search"):
+            path, lexical_matches = lexical_index.classify(user_input)
+    if path in CONFIDENT_PATHS:
+        similar_docs = lexical_matches
+    else:
+        # Load the FAISS index, embedding only journeys added or changed since it was saved
+        faiss_index = await registry.aindex(entry, snapshot)
+        # Find the closest match
+        query_vector = await embeddings.aembed_query(user_input)
+        with stage("faiss_search"):
+            similar_docs = await run_blocking(faiss_index.search, query_vector, FUSION_CANDIDATES if path == 'fused' else 1)
+        if path == 'fused':
+            similar_docs = fuse_scores(lexical_matches, similar_docs)
+    count_match_path(path)
     if similar_docs:
-        closest_match = similar_docs[0].page_content
-        # Find the entry with the matching Journey Name and gather all associated methods
-        methods = []
-        alternatives_list = []
-        
-        # Load methods data from URL
-        methods_url = "https://opensheet.elk.sh/1vgJJHgyIrjip-6Z-yCW6caMgrZpJo1-waucKqvfg1HI/6"
-        methods_data = load_data_from_url(methods_url)
-        # print("methods mapping: ", methods_mapping)
-        
-        
-        # Match 'closest_match' with Journey Name (N) in the json_url
-        matched_entries = [entry for entry in data if entry.get('Journey Name (N)') == closest_match]
-        if not matched_entries:
-            raise HTTPException(status_code=404, detail="No matching agenda items found")
+        closest_match, _ = similar_docs[0]
 
-        # Retrieve all the Methods (N) that are associated with Journey Name (N) in the json_url
-        methods = []
-        for entry in matched_entries:
-            entry_methods = entry.get('Methods (N)', '')
-            if entry_methods:
-                methods.extend(entry_methods.split('; '))
-
-        # Remove duplicates from methods list
-        methods = list(set(methods))
-
-        # From the methods_data json, find all the methods in the Unique key
-        # and return Alt 1, Alt 2, Alt 3, Description (short), AI Response
-        alternatives_list = []
-        for method in methods:
-            method_entry = next((item for item in methods_data if item['Uniques'] == method), None)
-            if method_entry:
-                alternatives = {
-                    'Alt 1': method_entry.get('Alt 1', ''),
-                    'Alt 2': method_entry.get('Alt 2', ''),
-                    'Alt 3': method_entry.get('Alt 3', ''),
-                    'Description (short)': method_entry.get('Description (short)', ''),
-                    'AI Response': method_entry.get('AI Response', '')
-                }
-                alternatives_list.append({method: alternatives})
+        # Match 'closest_match' with Journey Name (N) through the catalog index
+        if closest_match not in snapshot.rows_by_journey:
+            raise HTTPException(status_code=404, detail="No matching agenda items found")
 
+        with stage("catalog_lookup"):
+            expanded = snapshot.expand_journey(closest_match)
         return JSONResponse({
             "closest_match": closest_match,
-            "methods": methods,
-            "alternatives": alternatives_list
+            **expanded,
+            "match_path": path,
+            "catalog": entry.name,
+            "catalog_age": snapshot.age(),
+            "bundle_version": snapshot.bundle_version
         })
-    
+    raise HTTPException(status_code=404, detail="No matching agenda items found")
+
+@app.post("/find_closest_match/batch")
+async def find_closest_match_batch(payload: dict, request: Request):
+    user_inputs = payload.get("user_inputs")
+    if not user_inputs or not isinstance(user_inputs, list):
+        raise HTTPException(status_code=400, detail="A list of user_inputs is required in the payload")
+    if len(user_inputs) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_SIZE} user_inputs are accepted per request")
+    if not all(isinstance(user_input, str) and user_input for user_input in user_inputs):
+        raise HTTPException(status_code=400, detail="user_inputs must be non-empty strings")
+    try:
+        k = int(payload.get("k", 1))
+        threshold = payload.get("threshold")
+        threshold = float(threshold) if threshold is not None else None
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="k must be an integer and threshold a number")
+    if k < 1:
+        raise HTTPException(status_code=400, detail="k must be at least 1")
+    entry = registry.resolve(payload, request.headers)
+
+    snapshot = await entry.catalog.aget()
+
+    # Every input is embedded so each match has a cosine score. The lexical matcher only
+    # changes the ranking of the inputs it recognizes: its single answer for k = 1, fused
+    # with the vector neighbours for k > 1.
+    classified = [('vector', [])] * len(user_inputs)
+    if LEXICAL_MATCH:
+        lexical_index = await entry.lexical.aget(snapshot)
+        with stage("lexical_search"):
+            classified = [lexical_index.classify(user_input) for user_input in user_inputs]
+
+    # One embeddings call for all inputs, then a single FAISS search over the whole matrix
+    faiss_index = await registry.aindex(entry, snapshot)
+    vectors = await embeddings.aembed_documents(user_inputs)
+    with stage("faiss_search"):
+        vector_ranked = await run_blocking(faiss_index.search_many, vectors, max(k, FUSION_CANDIDATES))
+    ranked = []
+    cosines = []
+    for i, vector_matches in enumerate(vector_ranked):
+        path, lexical_matches = classified[i]
+        if path in CONFIDENT_PATHS and k > 1:
+            path = 'fused'
+            classified[i] = (path, lexical_matches)
+        if path == 'fused':
+            ranked.append(fuse_scores(lexical_matches, vector_matches)[:k])
+        elif path in CONFIDENT_PATHS:
+            ranked.append(lexical_matches[:1])
+        else:
+            ranked.append(vector_matches[:k])
+        cosines.append(dict(vector_matches))
+
+    # Lexical picks outside an input's vector neighbours are scored against their own vector
+    missing = sorted({name for matches, cosine in zip(ranked, cosines) for name, _ in matches if name not in cosine})
+    if missing:
+        documents = journey_documents(snapshot)
+        journey_vectors = dict(zip(missing, normalize(await embeddings.aembed_documents([documents[name] for name in missing]))))
+        query_vectors = normalize(vectors)
+        for i, (matches, cosine) in enumerate(zip(ranked, cosines)):
+            for name, _ in matches:
+                if name not in cosine:
+                    cosine[name] = float(query_vectors[i] @ journey_vectors[name])
+
+    # Journeys are expanded once no matter how many inputs resolve to them
+    journeys = {}
+    results = []
+    for user_input, matches, cosine, (path, _) in zip(user_inputs, ranked, cosines, classified):
+        count_match_path(path)
+        kept = []
+        for journey_name, rank_score in matches:
+            score = cosine[journey_name]
+            if threshold is not None and score < threshold:
+                continue
+            if journey_name not in snapshot.rows_by_journey:
+                continue
+            if journey_name not in journeys:
+                journeys[journey_name] = snapshot.expand_journey(journey_name)
+            match = {"closest_match": journey_name, "score": round(score, 4)}
+            if path == 'fused':
+                match["fused_score"] = round(rank_score, 4)
+            elif path in CONFIDENT_PATHS:
+                match["lexical_score"] = round(rank_score, 4)
+            kept.append(match)
+        results.append({"user_input": user_input, "matches": kept, "match_path": path})
+
+    return JSONResponse({
+        "results": results,
+        "journeys": journeys,
+        "catalog": entry.name,
+        "catalog_age": snapshot.age(),
+        "bundle_version": snapshot.bundle_version
+    })
+
+@app.post("/refresh_catalog")
+async def refresh_catalog(request: Request):
+    entry = registry.resolve(request.query_params, request.headers)
+    try:
+        snapshot = await entry.catalog.arefresh()
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Catalog refresh failed: {e}")
+    await registry.aindex(entry, snapshot)
+    return JSONResponse({"refreshed": True, "catalog": entry.name, "catalog_age": snapshot.age()})
+
+async def warm_up():
+    # Sheet fetch and index load happen here instead of in the first request
+    with startup.phase("catalog"):
+        snapshot = await catalog.aget()
+    with startup.phase("index"):
+        await registry.aindex(registry.default, snapshot)
+
+startup.install_fastapi(app, warm_up)
+methods_api.install_fastapi(app, registry)
+catalog_registry.install_fastapi(app, registry)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_http_client()
+
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
 
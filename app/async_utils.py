@@ -0,0 +1,40 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+# Threads available for CPU-bound index work off the event loop
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", "4"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+
+_executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="compass-cpu")
+_http_client = None
+
+
+def get_http_client():
+    # One pooled keep-alive client per process, shared by every request
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+            follow_redirects=True,
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def run_blocking(func, *args, **kwargs):
+    # Runs in a copy of the caller's context, so stage timings and the request deadline
+    # carry over to the worker thread
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, functools.partial(context.run, func, *args, **kwargs))
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import re
+import threading
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+from async_utils import run_blocking
+from prompt_builder import COMPLETION_MAX_TOKENS
+from resilience import EMBEDDINGS_TIMEOUT, LLM_TIMEOUT
+
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "openai")  # openai or local
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")  # openai or stub
+LOCAL_EMBEDDING_DIM = int(os.getenv("LOCAL_EMBEDDING_DIM", "256"))
+OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-ada-002")
+
+
+class LocalHashEmbeddings(Embeddings):
+    # Deterministic offline embeddings: word tokens and character trigrams hashed into a
+    # fixed number of buckets, L2-normalized. Similar strings share buckets, which is enough
+    # to exercise matching without network access.
+
+    def __init__(self, dim=LOCAL_EMBEDDING_DIM):
+        self.dim = dim
+        self.model = f"local-hash-{dim}"
+
+    def _features(self, text):
+        text = text.lower()
+        words = re.findall(r'\w+', text)
+        padded = f" {' '.join(words)} "
+        return words + [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], 'little') % self.dim
+            sign = 1.0 if digest[4] & 1 else -1.0
+            vector[bucket] += sign
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+    async def aembed_documents(self, texts):
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+
+class LazyOpenAIEmbeddings(Embeddings):
+    # OpenAIEmbeddings, with langchain's OpenAI module imported on the first embedding call
+    # rather than when a service module is imported. The model name is known up front, so
+    # the embedding cache works without loading it.
+
+    def __init__(self, openai_api_key=None, model=OPENAI_EMBEDDING_MODEL):
+        self.model = model
+        self.openai_api_key = openai_api_key
+        self._embeddings = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._embeddings is None:
+                from langchain.embeddings.openai import OpenAIEmbeddings
+                # The client gives up on its own too, so abandoned calls do not linger
+                options = {'openai_api_key': self.openai_api_key} if self.openai_api_key else {}
+                self._embeddings = OpenAIEmbeddings(model=self.model, request_timeout=EMBEDDINGS_TIMEOUT, **options)
+            return self._embeddings
+
+    async def _aload(self):
+        if self._embeddings is not None:
+            return self._embeddings
+        return await run_blocking(self._load)
+
+    def embed_documents(self, texts):
+        return self._load().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self._load().embed_query(text)
+
+    async def aembed_documents(self, texts):
+        return await (await self._aload()).aembed_documents(texts)
+
+    async def aembed_query(self, text):
+        return await (await self._aload()).aembed_query(text)
+
+
+def get_embeddings(openai_api_key=None):
+    if EMBEDDINGS_BACKEND == 'local':
+        return LocalHashEmbeddings()
+    return LazyOpenAIEmbeddings(openai_api_key)
+
+
+def get_chat_model(openai_api_key=None, model="gpt-4", temperature=.2, max_tokens=COMPLETION_MAX_TOKENS):
+    # Chat model modules are imported on first use; they are the slowest part of langchain to load
+    if LLM_BACKEND == 'stub':
+        from stub_llm import StubChatModel
+        return StubChatModel()
+    from langchain.chat_models import ChatOpenAI
+    return ChatOpenAI(model=model, temperature=temperature, openai_api_key=openai_api_key, request_timeout=LLM_TIMEOUT,
+                      max_tokens=max_tokens)
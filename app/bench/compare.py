@@ -0,0 +1,43 @@
+import argparse
+import json
+
+# Compares two result files written by bench.micro or bench.load, e.g.
+#   python -m bench.compare bench/results/load-...-abc123.json bench/results/load-...-def456.json
+
+
+def flatten(value, prefix=''):
+    if isinstance(value, dict):
+        items = {}
+        for key, child in value.items():
+            items.update(flatten(child, f"{prefix}.{key}" if prefix else key))
+        return items
+    if isinstance(value, list):
+        items = {}
+        for i, child in enumerate(value):
+            # Label list entries by size or concurrency when present so runs line up
+            label = child.get('journeys', child.get('concurrency', i)) if isinstance(child, dict) else i
+            items.update(flatten(child, f"{prefix}[{label}]"))
+        return items
+    return {prefix: value}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show relative changes between two benchmark result files")
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=0.10, help="flag changes above this fraction")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print(f"{baseline.get('commit')} -> {candidate.get('commit')} ({baseline['kind']})")
+    before, after = flatten(baseline['results']), flatten(candidate['results'])
+    for key in sorted(before):
+        old, new = before[key], after.get(key)
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or not old:
+            continue
+        change = (new - old) / old
+        flag = '  <--' if abs(change) > args.threshold else ''
+        print(f"{key:<60} {old:>12} {new:>12} {change:+8.1%}{flag}")
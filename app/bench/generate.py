@@ -0,0 +1,21 @@
+import argparse
+import json
+
+from mock_sheets import generate_catalog
+
+# Writes a synthetic catalog that mock_sheets.py can serve through MOCK_SHEETS_FILE:
+#   python -m bench.generate --journeys 10000 --methods 2000 --output catalog-10k.json
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic journey/methods catalog")
+    parser.add_argument('--journeys', type=int, default=1000)
+    parser.add_argument('--methods', type=int, default=500)
+    parser.add_argument('--agenda-items', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    catalog = generate_catalog(args.journeys, args.methods, args.agenda_items, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(catalog, f)
+    print(f"Wrote {args.journeys} journeys ({len(catalog['journeys'])} rows) and {args.methods} methods to {args.output}")
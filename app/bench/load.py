@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench.results import percentiles, write_results
+from mock_sheets import generate_catalog
+
+# Load driver for the FastAPI services. Starts mock_sheets.py and the target app under
+# uvicorn on the offline backends, then measures latency and throughput at increasing
+# concurrency. Usage, from the app/ directory:
+#   python -m bench.load --target find_closest_match --journeys 10000 --concurrency 1,8,32,128
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {
+    'find_closest_match': ('FAISS_test:app', '/find_closest_match', lambda text: {"user_input": text}),
+    'get_recipe': ('test_w_FAISS:app', '/get_recipe', lambda text: {"recipe_name": text}),
+}
+
+
+def start(args, env, port):
+    process = subprocess.Popen(args, cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/docs", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{' '.join(args)} did not start on port {port}")
+
+
+async def drive(url, payloads, concurrency, total):
+    latencies = []
+    errors = 0
+    queue = iter(range(total))
+
+    async def worker(client):
+        nonlocal errors
+        for i in queue:
+            started = time.perf_counter()
+            try:
+                response = await client.post(url, json=payloads[i % len(payloads)])
+                response.raise_for_status()
+                latencies.append((time.perf_counter() - started) * 1000)
+            except httpx.HTTPError:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "latency_ms": percentiles(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the matching and recipe endpoints")
+    parser.add_argument('--target', choices=sorted(TARGETS), default='find_closest_match')
+    parser.add_argument('--journeys', type=int, default=1000)
+    parser.add_argument('--methods', type=int, default=500)
+    parser.add_argument('--concurrency', default='1,4,16,64')
+    parser.add_argument('--requests-per-level', type=int, default=500)
+    parser.add_argument('--llm-latency', type=float, default=0.0, help="stub LLM latency in seconds")
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    module_app, path, make_payload = TARGETS[args.target]
+    catalog = generate_catalog(args.journeys, args.methods)
+    names = sorted({row['Journey Name (N)'] for row in catalog['journeys']})
+    rng = random.Random(1)
+    payloads = [make_payload(f"{rng.choice(names).split(' ', 1)[0].lower()} session {i}") for i in range(1000)]
+
+    sheets_port, app_port = args.port, args.port + 1
+    with tempfile.TemporaryDirectory() as workdir:
+        catalog_file = os.path.join(workdir, 'catalog.json')
+        with open(catalog_file, 'w') as f:
+            json.dump(catalog, f)
+        env = dict(
+            os.environ,
+            MOCK_SHEETS_FILE=catalog_file,
+            MOCK_SHEETS_PORT=str(sheets_port),
+            EMBEDDINGS_BACKEND='local',
+            LLM_BACKEND='stub',
+            STUB_LLM_LATENCY=str(args.llm_latency),
+            RESPONSE_CACHE_BACKEND='off',
+            EMBEDDING_CACHE_PATH=os.path.join(workdir, 'embeddings.sqlite3'),
+            FAISS_INDEX_PATH=os.path.join(workdir, 'faiss_index'),
+            OPENSHEET_JOURNEYS_URL=f"http://127.0.0.1:{sheets_port}/sheet/5",
+            OPENSHEET_METHODS_URL=f"http://127.0.0.1:{sheets_port}/sheet/6",
+            PUBLISHED_SHEET_URL=f"http://127.0.0.1:{sheets_port}/",
+            # Nothing is warmed before the port opens, so the first request below is cold
+            STARTUP_WARMUP='off',
+        )
+        processes = []
+        try:
+            processes.append(start([sys.executable, 'mock_sheets.py'], env, sheets_port))
+            processes.append(start([sys.executable, '-m', 'uvicorn', module_app, '--port', str(app_port),
+                                    '--log-level', 'warning'], env, app_port))
+            url = f"http://127.0.0.1:{app_port}{path}"
+            # First request loads the catalog and builds the index
+            started = time.perf_counter()
+            httpx.post(url, json=payloads[0], timeout=600).raise_for_status()
+            cold_ms = round((time.perf_counter() - started) * 1000, 3)
+            print(f"cold request: {cold_ms} ms")
+
+            levels = []
+            for concurrency in [int(level) for level in args.concurrency.split(',')]:
+                level = asyncio.run(drive(url, payloads, concurrency, args.requests_per_level))
+                latency = level['latency_ms']
+                print(f"concurrency {concurrency:>4}: {level['throughput_rps']} req/s, p50 {latency['p50']} ms, "
+                      f"p95 {latency['p95']} ms, p99 {latency['p99']} ms, errors {level['errors']}")
+                levels.append(level)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    write_results('load', {"target": args.target, "cold_request_ms": cold_ms, "levels": levels}, args.output, vars(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+# Microbenchmarks always run on the offline backends
+os.environ.setdefault("EMBEDDINGS_BACKEND", "local")
+os.environ.setdefault("LLM_BACKEND", "stub")
+
+from backends import LocalHashEmbeddings
+from bench.results import percentiles, write_results
+from catalog import CatalogSnapshot
+from journey_index import JourneyIndexStore, journey_documents
+from mock_sheets import generate_catalog
+
+# Usage, from the app/ directory:
+#   python -m bench.micro --sizes 100,1000,10000,100000 --queries 500
+
+
+def elapsed_ms(started):
+    return (time.perf_counter() - started) * 1000
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(elapsed_ms(started))
+    return samples
+
+
+def bench_size(journeys, queries, k, repeat):
+    catalog = generate_catalog(journeys, max(50, journeys // 5))
+    rng = random.Random(0)
+    result = {"journeys": journeys, "rows": len(catalog['journeys']), "methods": len(catalog['methods'])}
+
+    # Catalog parsing: building the snapshot and its lookup indexes
+    parse_samples = timed(lambda: CatalogSnapshot(catalog['journeys'], catalog['methods'], time.time()), repeat)
+    result["catalog_parse_ms"] = percentiles(parse_samples)
+    snapshot = CatalogSnapshot(catalog['journeys'], catalog['methods'], time.time())
+
+    embeddings = LocalHashEmbeddings()
+    documents = journey_documents(snapshot)
+    names = list(documents)
+    started = time.perf_counter()
+    vectors = embeddings.embed_documents([documents[name] for name in names])
+    result["embed_journeys_ms"] = round(elapsed_ms(started), 3)
+
+    # Index build from precomputed vectors, including the write to disk
+    with tempfile.TemporaryDirectory() as path:
+        store = JourneyIndexStore(path, embeddings)
+        started = time.perf_counter()
+        index = store._apply(None, documents, [], names, vectors)
+        result["index_build_ms"] = round(elapsed_ms(started), 3)
+
+    # Similarity search, one query at a time and as one batch
+    query_texts = [f"{rng.choice(names).split(' ', 1)[0].lower()} session {i}" for i in range(queries)]
+    query_vectors = embeddings.embed_documents(query_texts)
+    search_samples = []
+    matched = []
+    for vector in query_vectors:
+        started = time.perf_counter()
+        hits = index.search(vector, k)
+        search_samples.append(elapsed_ms(started))
+        matched.append(hits[0][0])
+    result["search_ms"] = percentiles(search_samples)
+    started = time.perf_counter()
+    index.search_many(query_vectors, k)
+    result["batch_search_total_ms"] = round(elapsed_ms(started), 3)
+
+    # Method expansion for the matched journeys
+    expand_samples = []
+    for name in matched:
+        started = time.perf_counter()
+        snapshot.expand_journey(name)
+        expand_samples.append(elapsed_ms(started))
+    result["method_expansion_ms"] = percentiles(expand_samples)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks for catalog parsing, index build, search and method expansion")
+    parser.add_argument('--sizes', default='100,1000,10000', help="comma-separated journey counts")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = []
+    for size in sizes:
+        result = bench_size(size, args.queries, args.k, args.repeat)
+        print(f"{size:>7} journeys: parse p50 {result['catalog_parse_ms']['p50']} ms, "
+              f"build {result['index_build_ms']} ms, search p50 {result['search_ms']['p50']} ms, "
+              f"expand p50 {result['method_expansion_ms']['p50']} ms")
+        results.append(result)
+    write_results('micro', results, args.output, vars(args))
@@ -0,0 +1,47 @@
+import datetime
+import json
+import os
+import platform
+import subprocess
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def percentiles(samples_ms):
+    if not samples_ms:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    ordered = sorted(samples_ms)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99),
+            "mean": round(sum(ordered) / len(ordered), 3)}
+
+
+def write_results(kind, results, output=None, params=None):
+    # One JSON document per run, named after the commit so runs can be diffed
+    commit = git_commit()
+    document = {
+        "kind": kind,
+        "commit": commit,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "params": params or {},
+        "results": results,
+    }
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"{kind}-{stamp}-{commit or 'nogit'}.json")
+    with open(output, 'w') as f:
+        json.dump(document, f, indent=2)
+    print(f"Results written to {output}")
+    return output
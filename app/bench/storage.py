@@ -0,0 +1,72 @@
+import argparse
+import os
+import random
+import time
+
+import faiss
+import numpy as np
+
+os.environ.setdefault("EMBEDDINGS_BACKEND", "local")
+
+from backends import LocalHashEmbeddings
+from bench.results import percentiles, write_results
+from journey_index import STORAGE_CODES, build_index, journey_id, recall_against_flat
+from mock_sheets import generate_catalog
+
+# Compares the vector encodings available to the journey index: bytes per vector, build
+# time, search latency and recall@k against an exact float32 search. Usage, from app/:
+#   python -m bench.storage --sizes 1000,10000,100000 --k 10
+
+
+def bench_layout(storage, ivf_threshold, vectors, ids, queries, k):
+    started = time.perf_counter()
+    index, label = build_index(vectors, ids, storage, ivf_threshold)
+    build_ms = (time.perf_counter() - started) * 1000
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        index.search(query.reshape(1, -1), k)
+        samples.append((time.perf_counter() - started) * 1000)
+    return {
+        "storage": label,
+        "build_ms": round(build_ms, 3),
+        "bytes_per_vector": round(len(faiss.serialize_index(index)) / len(ids), 1),
+        "recall_at_k": recall_against_flat(index, vectors, ids, queries, k),
+        "search_ms": percentiles(samples),
+    }
+
+
+def bench_size(journeys, queries, k):
+    catalog = generate_catalog(journeys, max(50, journeys // 5))
+    names = sorted({row['Journey Name (N)'] for row in catalog['journeys']})
+    embeddings = LocalHashEmbeddings()
+    vectors = np.asarray(embeddings.embed_documents(names), dtype=np.float32)
+    rng = random.Random(0)
+    query_texts = [f"{rng.choice(names).split(' ', 1)[0].lower()} session {i}" for i in range(queries)]
+    query_vectors = np.asarray(embeddings.embed_documents(query_texts), dtype=np.float32)
+    ids = [journey_id(name) for name in names]
+    layouts = [(storage, 0) for storage in STORAGE_CODES]
+    # IVF-PQ needs enough vectors to train its coarse quantizer and codebooks
+    if len(names) >= 10000:
+        layouts.append(('fp16', 1))
+    return {"journeys": len(names), "dim": vectors.shape[1],
+            "layouts": [bench_layout(storage, threshold, vectors, ids, query_vectors, k) for storage, threshold in layouts]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bytes per vector and recall of the journey index encodings")
+    parser.add_argument('--sizes', default='1000,10000', help="comma-separated journey counts")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        result = bench_size(size, args.queries, args.k)
+        for layout in result['layouts']:
+            print(f"{result['journeys']:>7} journeys {layout['storage']:>7}: {layout['bytes_per_vector']} bytes/vector, "
+                  f"recall@{args.k} {layout['recall_at_k']}, build {layout['build_ms']} ms, "
+                  f"search p50 {layout['search_ms']['p50']} ms")
+        results.append(result)
+    write_results('storage', results, args.output, vars(args))
@@ -0,0 +1,126 @@
+import argparse
+import os
+import random
+import time
+
+import numpy as np
+
+os.environ.setdefault("EMBEDDINGS_BACKEND", "local")
+
+from backends import LocalHashEmbeddings
+from bench.results import percentiles, write_results
+from journey_index import VECTOR_IVF_THRESHOLD, VECTOR_STORAGE, build_index, normalize
+from mock_sheets import generate_catalog
+from vector_stores import VECTOR_STORES, VectorStore, build_store
+
+# Compares the vector stores selectable with VECTOR_STORE on the same embeddings: build
+# time, memory, single-query latency, batch throughput and recall@k against an exact
+# search. Usage, from app/:
+#   python -m bench.vector_stores --sizes 1000,10000 --k 10
+#   python -m bench.vector_stores --stores numpy,faiss-hnsw --sizes 100000
+
+
+class JourneyIndexAdapter(VectorStore):
+    # The persisted journey index (VECTOR_STORE=faiss) in its VECTOR_STORAGE encoding
+    kind = 'faiss'
+
+    def _build(self, vectors):
+        self.index, self.label = build_index(vectors, np.arange(len(vectors), dtype=np.int64), VECTOR_STORAGE,
+                                             VECTOR_IVF_THRESHOLD)
+
+    def _search(self, queries, k):
+        return self.index.search(queries, k)
+
+    def nbytes(self):
+        import faiss
+        return len(faiss.serialize_index(self.index))
+
+
+def rss_bytes():
+    # Resident set size of this process (Linux); None elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def recall(results, exact, positions, k):
+    # Same tie-aware definition as journey_index.recall_against_flat: a result counts when
+    # its exact score reaches the k-th best exact score
+    kth_best = -np.partition(-exact, k - 1, axis=1)[:, k - 1]
+    hits = sum(exact[row, positions[name]] >= kth_best[row] - 1e-5
+               for row, matches in enumerate(results) for name, _ in matches)
+    return round(float(hits) / (k * len(results)), 4)
+
+
+def bench_store(kind, names, vectors, queries, exact, k):
+    before = rss_bytes()
+    started = time.perf_counter()
+    store = JourneyIndexAdapter(names, vectors) if kind == 'faiss' else build_store(kind, names, vectors)
+    build_ms = (time.perf_counter() - started) * 1000
+    after = rss_bytes()
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        store.search(query, k)
+        samples.append((time.perf_counter() - started) * 1000)
+    started = time.perf_counter()
+    results = store.search_many(queries, k)
+    batch_seconds = time.perf_counter() - started
+    positions = {name: i for i, name in enumerate(names)}
+    return {
+        "store": f"faiss ({store.label})" if kind == 'faiss' else kind,
+        "build_ms": round(build_ms, 3),
+        "bytes_per_vector": round(store.nbytes() / len(names), 1),
+        "rss_delta_mb": round((after - before) / 2 ** 20, 2) if before is not None and after is not None else None,
+        "search_ms": percentiles(samples),
+        "batch_qps": round(len(queries) / batch_seconds, 1) if batch_seconds else None,
+        "recall_at_k": recall(results, exact, positions, k),
+    }
+
+
+def bench_size(journeys, stores, queries, k):
+    catalog = generate_catalog(journeys, max(50, journeys // 5))
+    names = sorted({row['Journey Name (N)'] for row in catalog['journeys']})
+    embeddings = LocalHashEmbeddings()
+    vectors = normalize(embeddings.embed_documents(names))
+    rng = random.Random(0)
+    query_texts = [f"{rng.choice(names).split(' ', 1)[0].lower()} session {i}" for i in range(queries)]
+    query_vectors = normalize(embeddings.embed_documents(query_texts))
+    exact = query_vectors @ vectors.T
+    k = min(k, len(names))
+    results = []
+    for kind in stores:
+        try:
+            results.append(bench_store(kind, names, vectors, query_vectors, exact, k))
+        except ImportError as e:
+            # chromadb is optional
+            results.append({"store": kind, "skipped": str(e)})
+    return {"journeys": len(names), "dim": vectors.shape[1], "stores": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build time, memory, latency and recall of the vector stores")
+    parser.add_argument('--sizes', default='1000,10000', help="comma-separated journey counts")
+    parser.add_argument('--stores', default=','.join(['faiss'] + sorted(VECTOR_STORES)),
+                        help="comma-separated VECTOR_STORE values")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    stores = [store.strip() for store in args.stores.split(',') if store.strip()]
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        result = bench_size(size, stores, args.queries, args.k)
+        for store in result['stores']:
+            if 'skipped' in store:
+                print(f"{result['journeys']:>7} journeys {store['store']:>18}: skipped ({store['skipped']})")
+                continue
+            print(f"{result['journeys']:>7} journeys {store['store']:>18}: build {store['build_ms']} ms, "
+                  f"{store['bytes_per_vector']} bytes/vector, rss +{store['rss_delta_mb']} MB, "
+                  f"search p50 {store['search_ms']['p50']} ms p99 {store['search_ms']['p99']} ms, "
+                  f"batch {store['batch_qps']} q/s, recall@{args.k} {store['recall_at_k']}")
+        results.append(result)
+    write_results('vector_stores', results, args.output, vars(args))
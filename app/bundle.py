@@ -0,0 +1,167 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+from catalog import CatalogSnapshot, OPENSHEET_JOURNEYS_URL, OPENSHEET_METHODS_URL, PUBLISHED_SHEET_URL, load_data_from_url, normalize_rows
+from journey_index import JourneyIndexStore, VECTOR_STORAGE
+
+logger = logging.getLogger(__name__)
+
+# Prebuilt catalog + index bundles, one subdirectory per source. Servers load the current
+# bundle at startup and only build at runtime when there is none.
+BUNDLE_PATH = os.getenv("BUNDLE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bundles'))
+
+# The opensheet pair is used by FAISS_test.py, the published workbook by the other services
+SOURCES = {
+    'opensheet': (OPENSHEET_JOURNEYS_URL, OPENSHEET_METHODS_URL),
+    'published': (PUBLISHED_SHEET_URL, PUBLISHED_SHEET_URL),
+}
+
+MANIFEST_FILE = 'bundle.json'
+CURRENT_FILE = 'CURRENT'
+
+
+def catalog_hash(journeys, methods):
+    return hashlib.sha256(json.dumps({'journeys': journeys, 'methods': methods}, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Bundle:
+    def __init__(self, path, manifest, snapshot, journey_index):
+        self.path = path
+        self.manifest = manifest
+        self.version = manifest['version']
+        self.snapshot = snapshot
+        self.journey_index = journey_index
+
+
+def current_version(source_path):
+    try:
+        with open(os.path.join(source_path, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_bundle(source, embeddings, journeys_url, methods_url, root=BUNDLE_PATH):
+    # Current bundle for source, or None when there is none or it does not match the
+    # server's sheets or embeddings model. The index is memory-mapped read-only.
+    source_path = os.path.join(root, source)
+    version = current_version(source_path)
+    if version is None:
+        return None
+    path = os.path.join(source_path, version)
+    try:
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        if manifest['sources'] != {'journeys': journeys_url, 'methods': methods_url}:
+            logger.warning("Ignoring bundle %s: built from other sheets", path)
+            return None
+        model = getattr(embeddings, 'model', type(embeddings).__name__)
+        if manifest['model'] != model:
+            logger.warning("Ignoring bundle %s: built with %s, serving %s", path, manifest['model'], model)
+            return None
+        with open(os.path.join(path, 'journeys.json')) as f:
+            journeys = json.load(f)
+        with open(os.path.join(path, 'methods.json')) as f:
+            methods = json.load(f)
+        journey_index = JourneyIndexStore(os.path.join(path, 'index'), embeddings).load()
+    except Exception as e:
+        logger.warning("Ignoring unreadable bundle %s: %s", path, e)
+        return None
+    if journey_index is None:
+        return None
+    snapshot = CatalogSnapshot(journeys, methods, manifest['built_at'], manifest['version'])
+    logger.info("Loaded bundle %s (%d journeys)", manifest['version'], len(journey_index))
+    return Bundle(path, manifest, snapshot, journey_index)
+
+
+def seed_from_bundle(bundle, catalog, journey_index=None):
+    # Serve the bundle's catalog (and index) until the catalog TTL triggers a refresh
+    if bundle is None:
+        return
+    catalog.seed(bundle.snapshot)
+    if journey_index is not None:
+        journey_index.seed(bundle.snapshot, bundle.journey_index)
+
+
+def build_bundle(source, embeddings, root=BUNDLE_PATH, storage=VECTOR_STORAGE, force=False):
+    journeys_url, methods_url = SOURCES[source]
+    journeys = normalize_rows(load_data_from_url(journeys_url))
+    methods = journeys if methods_url == journeys_url else normalize_rows(load_data_from_url(methods_url))
+    content_hash = catalog_hash(journeys, methods)
+    model = getattr(embeddings, 'model', type(embeddings).__name__)
+
+    source_path = os.path.join(root, source)
+    current = current_version(source_path)
+    if current and not force:
+        try:
+            with open(os.path.join(source_path, current, MANIFEST_FILE)) as f:
+                previous = json.load(f)
+            if (previous['content_hash'], previous['model'], previous['storage']) == (content_hash, model, storage):
+                logger.info("Bundle %s is up to date", current)
+                return os.path.join(source_path, current), previous
+        except (OSError, ValueError, KeyError):
+            pass
+
+    built_at = time.time()
+    version = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(built_at))}-{content_hash[:12]}"
+    path = os.path.join(source_path, version)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'journeys.json'), 'w') as f:
+        json.dump(journeys, f)
+    with open(os.path.join(path, 'methods.json'), 'w') as f:
+        json.dump(methods, f)
+
+    snapshot = CatalogSnapshot(journeys, methods, built_at)
+    store = JourneyIndexStore(os.path.join(path, 'index'), embeddings, storage=storage)
+    journey_index = store.sync(snapshot)
+    if not len(journey_index):
+        raise RuntimeError(f"No journeys found in {journeys_url}")
+
+    manifest = {
+        'version': version,
+        'built_at': built_at,
+        'content_hash': content_hash,
+        'model': model,
+        'storage': journey_index.info['storage'],
+        'sources': {'journeys': journeys_url, 'methods': methods_url},
+        'journeys': len(snapshot.journey_names),
+        'methods': len(snapshot.method_by_unique),
+        'index': journey_index.stats(),
+    }
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    # Servers pick the new bundle up through CURRENT, which is replaced atomically
+    tmp_path = os.path.join(source_path, f"{CURRENT_FILE}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, 'w') as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(source_path, CURRENT_FILE))
+    return path, manifest
+
+
+if __name__ == "__main__":
+    # Usage, from the app/ directory:
+    #   python bundle.py --source opensheet
+    #   python bundle.py --source published --output /srv/bundles --storage sq8
+    from dotenv import load_dotenv
+    load_dotenv()
+    from backends import get_embeddings
+    from embedding_cache import CachedEmbeddings
+
+    parser = argparse.ArgumentParser(description="Fetch the sheets, embed every journey and write a versioned bundle")
+    parser.add_argument('--source', choices=sorted(SOURCES), default='opensheet')
+    parser.add_argument('--output', default=BUNDLE_PATH)
+    parser.add_argument('--storage', default=VECTOR_STORAGE)
+    parser.add_argument('--force', action='store_true', help="build even if the current bundle matches the sheets")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    started = time.perf_counter()
+    path, manifest = build_bundle(args.source, CachedEmbeddings(get_embeddings(os.getenv("OPENAI_API_KEY"))),
+                                  args.output, args.storage, args.force)
+    print(f"Bundle {manifest['version']}: {manifest['journeys']} journeys, {manifest['methods']} methods, "
+          f"{manifest['model']} {manifest['storage']} at {path} ({time.perf_counter() - started:.1f}s)")
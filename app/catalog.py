@@ -0,0 +1,293 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from async_utils import get_http_client, run_blocking
+from metrics import stage, upstream
+from resilience import SHEETS_HEDGE_AFTER, SHEETS_TIMEOUT, acall, call, clear_budget
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Sheet sources. The opensheet endpoints split journeys (gid 5) and methods (gid 6);
+# the gs.jasonaa.me proxy serves the published workbook (gid 1980586524) with both in one sheet.
+# Each can be pointed elsewhere, e.g. at mock_sheets.py for offline runs.
+OPENSHEET_JOURNEYS_URL = os.getenv("OPENSHEET_JOURNEYS_URL", "https://opensheet.elk.sh/1vgJJHgyIrjip-6Z-yCW6caMgrZpJo1-waucKqvfg1HI/5")
+OPENSHEET_METHODS_URL = os.getenv("OPENSHEET_METHODS_URL", "https://opensheet.elk.sh/1vgJJHgyIrjip-6Z-yCW6caMgrZpJo1-waucKqvfg1HI/6")
+PUBLISHED_SHEET_URL = os.getenv("PUBLISHED_SHEET_URL", 'https://gs.jasonaa.me/?url=https://docs.google.com/spreadsheets/d/e/2PACX-1vSmp889ksBKKVVwpaxhlIzpDzXNOWjnszEXBP7SC5AyoebSIBFuX5qrcwwv6ud4RCYw2t_BZRhGLT0u/pubhtml?gid=1980586524&single=true')
+
+# Seconds before the cached sheets are considered stale and refreshed in the background
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", "300"))
+
+
+def load_data_from_url(url):
+    # Sheet reads are idempotent, so a slow one is hedged with a second request
+    def fetch(timeout):
+        response = requests.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    with upstream("sheets"):
+        return call("sheets", fetch, SHEETS_TIMEOUT, SHEETS_HEDGE_AFTER)
+
+
+async def async_load_data_from_url(url):
+    async def fetch(timeout):
+        response = await get_http_client().get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    with upstream("sheets"):
+        return await acall("sheets", fetch, SHEETS_TIMEOUT, SHEETS_HEDGE_AFTER)
+
+
+def normalize_rows(rows):
+    # Trimmed string cells, and no rows that are empty after trimming
+    normalized = []
+    for row in rows:
+        row = {key.strip(): value.strip() if isinstance(value, str) else value for key, value in row.items()}
+        if any(value not in ('', None) for value in row.values()):
+            normalized.append(row)
+    return normalized
+
+
+def split_methods(cell):
+    return [method.strip() for method in cell.split('; ') if method.strip()]
+
+
+class CatalogSnapshot:
+    # Immutable view of one catalog load. The lookup indexes are built once here so
+    # request handlers never scan the sheet rows. Rows are normalized here, so a fetched
+    # catalog and a bundled one with the same content fingerprint the same.
+    # bundle_version is set on snapshots loaded from a bundle.
+
+    def __init__(self, journeys, methods, loaded_at, bundle_version=None):
+        self.journeys = normalize_rows(journeys)
+        self.methods = self.journeys if methods is journeys else normalize_rows(methods)
+        self.loaded_at = loaded_at
+        self.bundle_version = bundle_version
+        self._method_table = None
+        self._build_indexes()
+
+    def _build_indexes(self):
+        # Journey Name (N) -> rows, agenda items and de-duplicated methods, in sheet order
+        self.rows_by_journey = {}
+        self.agenda_by_journey = {}
+        self.methods_by_journey = {}
+        for entry in self.journeys:
+            name = entry.get('Journey Name (N)')
+            if not name:
+                continue
+            self.rows_by_journey.setdefault(name, []).append(entry)
+            agenda_item = entry.get('Agenda Items (Description)')
+            if agenda_item:
+                self.agenda_by_journey.setdefault(name, []).append(agenda_item)
+            journey_methods = self.methods_by_journey.setdefault(name, [])
+            for method in split_methods(entry.get('Methods (N)') or ''):
+                if method not in journey_methods:
+                    journey_methods.append(method)
+        self.journey_names = list(self.rows_by_journey)
+
+        # Uniques -> first methods row carrying it
+        self.method_by_unique = {}
+        for entry in self.methods:
+            unique = (entry.get('Uniques') or '').strip()
+            if unique and unique not in self.method_by_unique:
+                self.method_by_unique[unique] = entry
+
+    def age(self):
+        return round(time.time() - self.loaded_at, 3)
+
+    def journey_fingerprint(self, journey_name):
+        # Changes whenever any sheet row of this journey changes
+        rows = self.rows_by_journey.get(journey_name, [])
+        return hashlib.sha256(json.dumps(rows, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_agenda_items(self, journey_name):
+        return self.agenda_by_journey.get(journey_name) or None
+
+    def get_methods(self, journey_name):
+        return self.methods_by_journey.get(journey_name) or None
+
+    def get_method_details(self, methods_list):
+        method_details = []
+        for method in methods_list or []:
+            entry = self.method_by_unique.get(method)
+            if entry:
+                method_details.append({
+                    'method': method,
+                    'description_short': entry.get('Description (short)', ''),
+                    'ai_response': entry.get('AI Response', '')
+                })
+        return method_details
+
+    def get_alternatives(self, method):
+        entry = self.method_by_unique.get(method)
+        if entry is None:
+            return None
+        return {
+            'Alt 1': entry.get('Alt 1', ''),
+            'Alt 2': entry.get('Alt 2', ''),
+            'Alt 3': entry.get('Alt 3', ''),
+            'Description (short)': entry.get('Description (short)', ''),
+            'AI Response': entry.get('AI Response', '')
+        }
+
+    def method_table(self):
+        # (rows, digest) for GET /methods: one row per Uniques in sheet order, with the
+        # alternatives of every sheet row carrying it, as src/Chat.js groups them. The
+        # digest only depends on the content, so it is stable across identical reloads.
+        if self._method_table is None:
+            rows = {}
+            for entry in self.methods:
+                unique = (entry.get('Uniques') or '').strip()
+                if not unique:
+                    continue
+                row = rows.setdefault(unique, {
+                    'method': unique,
+                    'alternatives': [],
+                    'description': entry.get('Description (short)', ''),
+                    'ai_response': entry.get('AI Response', '')
+                })
+                for column in ('Alt 1', 'Alt 2', 'Alt 3'):
+                    if entry.get(column):
+                        row['alternatives'].append(entry[column])
+            rows = list(rows.values())
+            digest = hashlib.sha256(json.dumps(rows, sort_keys=True).encode('utf-8')).hexdigest()
+            self._method_table = (rows, digest)
+        return self._method_table
+
+    def expand_journey(self, journey_name):
+        # Methods (N) are pre-split and de-duplicated per journey
+        methods = self.methods_by_journey[journey_name]
+
+        # Look up Alt 1, Alt 2, Alt 3, Description (short), AI Response by Uniques
+        alternatives_list = []
+        for method in methods:
+            alternatives = self.get_alternatives(method)
+            if alternatives:
+                alternatives_list.append({method: alternatives})
+        return {"methods": methods, "alternatives": alternatives_list}
+
+
+class Catalog:
+    # Holds the journey and methods sheets in memory. Once loaded, stale data keeps being
+    # served while a single background thread refreshes it, so a slow or failing proxy
+    # only delays the first request of the process. The a-prefixed methods do the same on
+    # the event loop with the shared async HTTP client.
+
+    def __init__(self, journeys_url, methods_url, ttl=CATALOG_TTL):
+        self.journeys_url = journeys_url
+        self.methods_url = methods_url
+        self.ttl = ttl
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._async_lock = asyncio.Lock()
+        self._refresh_task = None
+        self._refreshing = False
+        self.last_error = None
+        # Overlapping refreshes (cold start, TTL, /refresh_catalog) share one sheet fetch
+        self._flight = SingleFlight("sheets")
+
+    def _fetch(self):
+        journeys = load_data_from_url(self.journeys_url)
+        # Both roles may point at the same sheet; fetch it once
+        if self.methods_url == self.journeys_url:
+            methods = journeys
+        else:
+            methods = load_data_from_url(self.methods_url)
+        with stage("catalog_parse"):
+            return CatalogSnapshot(journeys, methods, time.time())
+
+    def seed(self, snapshot):
+        # Start from a prebuilt snapshot (e.g. an artifact bundle); it ages and is
+        # refreshed like one fetched here
+        if self._snapshot is None:
+            self._snapshot = snapshot
+
+    def refresh(self):
+        snapshot = self._flight.run_sync('refresh', self._fetch)
+        self._snapshot = snapshot
+        self.last_error = None
+        return snapshot
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            # Keep serving the stale snapshot until the proxy recovers
+            self.last_error = str(e)
+            logger.warning("Catalog refresh failed, serving stale data: %s", e)
+        finally:
+            self._refreshing = False
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    return self.refresh()
+                return self._snapshot
+        if snapshot.age() > self.ttl:
+            with self._lock:
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._background_refresh, daemon=True).start()
+        return snapshot
+
+    async def _afetch(self):
+        if self.methods_url == self.journeys_url:
+            journeys = methods = await async_load_data_from_url(self.journeys_url)
+        else:
+            journeys, methods = await asyncio.gather(
+                async_load_data_from_url(self.journeys_url),
+                async_load_data_from_url(self.methods_url),
+            )
+        # Building the lookup indexes is CPU work; keep it off the event loop
+        with stage("catalog_parse"):
+            return await run_blocking(CatalogSnapshot, journeys, methods, time.time())
+
+    async def arefresh(self):
+        snapshot = await self._flight.run('refresh', self._afetch)
+        self._snapshot = snapshot
+        self.last_error = None
+        return snapshot
+
+    async def _abackground_refresh(self):
+        # Runs past the request that started it
+        clear_budget()
+        try:
+            await self.arefresh()
+        except Exception as e:
+            self.last_error = str(e)
+            logger.warning("Catalog refresh failed, serving stale data: %s", e)
+        finally:
+            self._refreshing = False
+
+    async def aget(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            async with self._async_lock:
+                if self._snapshot is None:
+                    return await self.arefresh()
+                return self._snapshot
+        if snapshot.age() > self.ttl and not self._refreshing:
+            self._refreshing = True
+            self._refresh_task = asyncio.get_running_loop().create_task(self._abackground_refresh())
+        return snapshot
+
+    def status(self):
+        snapshot = self._snapshot
+        return {
+            "loaded": snapshot is not None,
+            "age": snapshot.age() if snapshot else None,
+            "ttl": self.ttl,
+            "refreshing": self._refreshing,
+            "last_error": self.last_error,
+        }
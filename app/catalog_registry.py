@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from async_utils import run_blocking
+from catalog import Catalog
+from lexical import LexicalMatcher
+from metrics import count_catalog_index, set_catalog_index_bytes
+from vector_stores import journey_index_from_env
+
+logger = logging.getLogger(__name__)
+
+# Client catalogs served next to the default one, as JSON or the path of a JSON file:
+#   {"acme": {"journeys_url": "https://opensheet.elk.sh/<sheet id>/5",
+#             "methods_url": "https://opensheet.elk.sh/<sheet id>/6"},
+#    "globex": {"sheet_url": "https://gs.jasonaa.me/?url=...pubhtml?gid=<gid>&single=true"}}
+# sheet_url is a published workbook holding journeys and methods in one sheet.
+CATALOGS = os.getenv("CATALOGS", "")
+# Megabytes of vector indexes kept loaded across catalogs. Over it, the least recently
+# used indexes are unloaded and load again on their next request. 0 is unlimited.
+CATALOG_INDEX_BUDGET_MB = float(os.getenv("CATALOG_INDEX_BUDGET_MB", "0"))
+
+DEFAULT_CATALOG = 'default'
+# Names become part of index paths
+CATALOG_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class UnknownCatalog(KeyError):
+    pass
+
+
+class InvalidCatalog(ValueError):
+    pass
+
+
+def load_catalog_specs(value=CATALOGS):
+    # {name: (journeys_url, methods_url)}; ValueError for a malformed configuration
+    value = value.strip()
+    if not value:
+        return {}
+    if not value.startswith('{'):
+        with open(value) as f:
+            value = f.read()
+    specs = {}
+    for name, spec in json.loads(value).items():
+        if not CATALOG_NAME.match(name) or name == DEFAULT_CATALOG:
+            raise ValueError(f"Invalid catalog name {name!r}")
+        journeys_url = spec.get('journeys_url') or spec.get('sheet_url') if isinstance(spec, dict) else None
+        if not journeys_url:
+            raise ValueError(f"Catalog {name!r} needs a journeys_url or sheet_url")
+        specs[name] = (journeys_url, spec.get('methods_url') or journeys_url)
+    return specs
+
+
+class CatalogEntry:
+    # One catalog's sheets, lexical matcher and vector index, with index usage counters
+
+    def __init__(self, name, catalog, index, lexical=None):
+        self.name = name
+        self.catalog = catalog
+        self.index = index
+        self.lexical = lexical or LexicalMatcher()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.last_used = None
+
+
+class CatalogRegistry:
+    # Catalogs by name. The service builds the default one (possibly seeded from a bundle);
+    # the others are created on their first request from CATALOGS. Loaded vector indexes
+    # are tracked in LRU order and unloaded, least recently used first, while their total
+    # size is over the budget. The index a request just used is never unloaded, so a single
+    # index larger than the budget still serves.
+
+    def __init__(self, default, embeddings, index_path, index_default='faiss', specs=None,
+                 budget_mb=CATALOG_INDEX_BUDGET_MB):
+        self.default = default
+        self.embeddings = embeddings
+        self.index_path = index_path
+        self.index_default = index_default
+        self.specs = load_catalog_specs() if specs is None else specs
+        self.budget = int(budget_mb * 2 ** 20)
+        self._entries = {default.name: default}
+        # name -> bytes of its loaded index, least recently used first
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+
+    def names(self):
+        return [self.default.name] + sorted(self.specs)
+
+    def entry(self, name=None):
+        if not name or name == self.default.name:
+            return self.default
+        entry = self._entries.get(name)
+        if entry is not None:
+            return entry
+        if name not in self.specs:
+            raise UnknownCatalog(name)
+        with self._lock:
+            if name not in self._entries:
+                journeys_url, methods_url = self.specs[name]
+                # Each catalog persists its index next to the default one
+                index = journey_index_from_env(f"{self.index_path}-{name}", self.embeddings, self.index_default)
+                self._entries[name] = CatalogEntry(name, Catalog(journeys_url, methods_url), index)
+            return self._entries[name]
+
+    def resolve(self, values, headers):
+        # Catalog named by the request's "catalog" field or parameter, else by its
+        # X-Catalog header; raises InvalidCatalog or UnknownCatalog
+        name = values.get('catalog') or headers.get('x-catalog')
+        if name is not None and not isinstance(name, str):
+            raise InvalidCatalog("catalog must be a string")
+        return self.entry(name)
+
+    def _lookup(self, entry):
+        result = 'hit' if entry.index.current is not None else 'miss'
+        if result == 'hit':
+            entry.hits += 1
+        else:
+            entry.misses += 1
+        count_catalog_index(entry.name, result)
+
+    def index(self, entry, snapshot):
+        # entry's vector index for snapshot, loading it if it was never loaded or evicted
+        self._lookup(entry)
+        index = entry.index.get(snapshot)
+        self._evict(self._touch(entry, index))
+        return index
+
+    async def aindex(self, entry, snapshot):
+        self._lookup(entry)
+        index = await entry.index.aget(snapshot)
+        evicted = self._touch(entry, index)
+        if evicted:
+            # unload() waits for a sync of that store in progress in another thread
+            await run_blocking(self._evict, evicted)
+        return index
+
+    def _touch(self, entry, index):
+        nbytes = index.nbytes() if index is not None else 0
+        entry.last_used = time.time()
+        evicted = []
+        with self._lock:
+            self._resident[entry.name] = nbytes
+            self._resident.move_to_end(entry.name)
+            total = sum(self._resident.values())
+            while self.budget and total > self.budget and len(self._resident) > 1:
+                name, size = self._resident.popitem(last=False)
+                total -= size
+                evicted.append(self._entries[name])
+        set_catalog_index_bytes(entry.name, nbytes)
+        return evicted
+
+    def _evict(self, evicted):
+        for other in evicted:
+            # Searches already holding the index finish on it; it is freed after them
+            other.index.unload()
+            other.evictions += 1
+            count_catalog_index(other.name, 'evicted')
+            set_catalog_index_bytes(other.name, 0)
+            logger.info("Unloaded the %s catalog index to stay within %d bytes", other.name, self.budget)
+
+    def stats(self):
+        with self._lock:
+            resident = dict(self._resident)
+        catalogs = {}
+        for name in self.names():
+            entry = self._entries.get(name)
+            lookups = entry.hits + entry.misses if entry else 0
+            catalogs[name] = {
+                "catalog": entry.catalog.status() if entry else None,
+                "resident": name in resident,
+                "index_bytes": resident.get(name),
+                "hits": entry.hits if entry else 0,
+                "misses": entry.misses if entry else 0,
+                "hit_rate": round(entry.hits / lookups, 4) if lookups else None,
+                "evictions": entry.evictions if entry else 0,
+                "idle_seconds": round(time.time() - entry.last_used, 1) if entry and entry.last_used else None,
+            }
+        return {
+            "budget_bytes": self.budget or None,
+            "resident_bytes": sum(resident.values()),
+            "catalogs": catalogs,
+        }
+
+
+def install_fastapi(app, registry):
+    # GET /catalogs, and 404 for requests naming a catalog that is not configured
+    from fastapi.responses import JSONResponse
+
+    @app.exception_handler(InvalidCatalog)
+    async def invalid_catalog(request, error):
+        return JSONResponse({"detail": str(error)}, status_code=400)
+
+    @app.exception_handler(UnknownCatalog)
+    async def unknown_catalog(request, error):
+        return JSONResponse({"detail": f"Unknown catalog {error.args[0]!r}"}, status_code=404)
+
+    @app.get("/catalogs")
+    async def catalogs():
+        return JSONResponse(registry.stats())
+
+
+def install_flask(app, registry):
+    from flask import jsonify
+
+    @app.errorhandler(InvalidCatalog)
+    def invalid_catalog(error):
+        return jsonify({"error": str(error)}), 400
+
+    @app.errorhandler(UnknownCatalog)
+    def unknown_catalog(error):
+        return jsonify({"error": f"Unknown catalog {error.args[0]!r}"}), 404
+
+    @app.route('/catalogs')
+    def catalogs():
+        return jsonify(registry.stats())
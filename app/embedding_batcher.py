@@ -0,0 +1,277 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+
+from metrics import record_embedding_batch, upstream
+from resilience import EMBEDDINGS_HEDGE_AFTER, EMBEDDINGS_TIMEOUT, acall, call, clear_budget, time_left, without_budget
+
+# Concurrent embedding calls arriving within this many milliseconds are sent as one
+# batched request; 0 sends every call on its own
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+# A batch is sent early once it holds this many texts or (estimated) tokens
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "50000"))
+# Embeddings requests in flight at once, per process
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))
+# Requests and tokens per minute allowed towards the embeddings API; 0 is unlimited
+EMBEDDING_RPM = float(os.getenv("EMBEDDING_RPM", "0"))
+EMBEDDING_TPM = float(os.getenv("EMBEDDING_TPM", "0"))
+
+
+def estimate_tokens(text):
+    # About four characters per token for English; avoids loading a tokenizer per call
+    return len(text) // 4 + 1
+
+
+class RateLimiter:
+    # Spaces requests out so neither the request nor the token rate exceeds its limit.
+    # reserve() books the capacity and returns how long the caller has to wait for it.
+
+    def __init__(self, rpm=EMBEDDING_RPM, tpm=EMBEDDING_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._next_request = 0.0
+        self._next_token = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens):
+        if not self.rpm and not self.tpm:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_request if self.rpm else now, self._next_token if self.tpm else now)
+            if self.rpm:
+                self._next_request = start + 60.0 / self.rpm
+            if self.tpm:
+                self._next_token = start + 60.0 * tokens / self.tpm
+            return start - now
+
+
+class _Batch:
+    def __init__(self):
+        self.calls = []
+        self.texts = 0
+        self.tokens = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.vectors = None
+        self.error = None
+
+
+class _LoopState:
+    # Pending calls of one event loop
+    def __init__(self):
+        self.calls = []
+        self.texts = 0
+        self.tokens = 0
+        self.timer = None
+        self.semaphore = asyncio.Semaphore(EMBEDDING_MAX_CONCURRENCY)
+
+
+class EmbeddingBatcher:
+    # Merges concurrent embedding calls into batched embed_documents requests and fans the
+    # vectors back out to the callers. A call is never split across batches; calls with
+    # EMBEDDING_BATCH_SIZE texts or EMBEDDING_BATCH_MAX_TOKENS tokens or more are sent on
+    # their own, in requests no larger than those limits. Every request, batched or not,
+    # goes through the concurrency and rate limits. Only single requests are hedged.
+    #
+    # bulk=True is for index builds: the call is chunked the same way but never hedged,
+    # and each chunk gets EMBEDDINGS_TIMEOUT regardless of the request budget, so the
+    # time allowed grows with the catalog.
+
+    def __init__(self, embeddings, window_ms=EMBEDDING_BATCH_WINDOW_MS, max_size=EMBEDDING_BATCH_SIZE,
+                 max_tokens=EMBEDDING_BATCH_MAX_TOKENS, limiter=None):
+        self.embeddings = embeddings
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.max_tokens = max_tokens
+        self.limiter = limiter or RateLimiter()
+        self._loops = weakref.WeakKeyDictionary()
+        self._batch = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(EMBEDDING_MAX_CONCURRENCY)
+
+    def _alone(self, texts, tokens):
+        return not self.window or len(texts) >= self.max_size or tokens >= self.max_tokens
+
+    def _fits(self, pending, texts, tokens):
+        return pending.texts + len(texts) <= self.max_size and pending.tokens + tokens <= self.max_tokens
+
+    def _chunks(self, texts):
+        # (texts, tokens) requests of at most max_size texts and max_tokens tokens, in
+        # order; a single text over max_tokens is sent on its own
+        chunks = []
+        chunk, tokens = [], 0
+        for text in texts:
+            cost = estimate_tokens(text)
+            if chunk and (len(chunk) >= self.max_size or tokens + cost > self.max_tokens):
+                chunks.append((chunk, tokens))
+                chunk, tokens = [], 0
+            chunk.append(text)
+            tokens += cost
+        if chunk:
+            chunks.append((chunk, tokens))
+        return chunks
+
+    # asyncio
+
+    async def aembed(self, texts, bulk=False):
+        # Timed per caller, so each request's embeddings stage includes its queue wait
+        with upstream("embeddings"):
+            if bulk:
+                with without_budget():
+                    return await self._asend_chunked(self._chunks(texts), self._loop_state().semaphore, hedge=False)
+            return await self._aembed(texts)
+
+    async def _aembed(self, texts):
+        # The wait is bounded by the request budget even when the batch is shared. A call
+        # sent in several chunks gets EMBEDDINGS_TIMEOUT per chunk.
+        tokens = sum(estimate_tokens(text) for text in texts)
+        state = self._loop_state()
+        if self._alone(texts, tokens):
+            chunks = self._chunks(texts)
+            return await asyncio.wait_for(self._asend_chunked(chunks, state.semaphore, hedge=len(chunks) == 1),
+                                          time_left(EMBEDDINGS_TIMEOUT * len(chunks)))
+        if state.calls and not self._fits(state, texts, tokens):
+            self._aflush(state)
+        future = asyncio.get_running_loop().create_future()
+        state.calls.append((texts, future, time.perf_counter()))
+        state.texts += len(texts)
+        state.tokens += tokens
+        if state.texts >= self.max_size or state.tokens >= self.max_tokens:
+            self._aflush(state)
+        elif state.timer is None:
+            state.timer = asyncio.get_running_loop().call_later(self.window, self._aflush, state)
+        return await asyncio.wait_for(future, time_left(EMBEDDINGS_TIMEOUT))
+
+    async def _asend_chunked(self, chunks, semaphore, hedge):
+        # The chunks run concurrently within the semaphore; if one fails the rest are cancelled
+        enqueued = time.perf_counter()
+        tasks = [asyncio.ensure_future(self._asend([chunk], tokens, [enqueued], semaphore, hedge=hedge))
+                 for chunk, tokens in chunks]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return [vector for vectors in results for vector in vectors]
+
+    def _loop_state(self):
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = self._loops[loop] = _LoopState()
+        return state
+
+    def _aflush(self, state):
+        if state.timer is not None:
+            state.timer.cancel()
+            state.timer = None
+        calls, tokens = state.calls, state.tokens
+        state.calls, state.texts, state.tokens = [], 0, 0
+        if calls:
+            asyncio.ensure_future(self._adeliver(calls, tokens, state.semaphore))
+
+    async def _adeliver(self, calls, tokens, semaphore):
+        # Shared by several requests, so bounded by EMBEDDINGS_TIMEOUT rather than by
+        # the budget of the request that happened to flush it
+        clear_budget()
+        try:
+            results = await self._asend([texts for texts, _, _ in calls], tokens,
+                                        [enqueued for _, _, enqueued in calls], semaphore, split=True)
+        except Exception as e:
+            for _, future, _ in calls:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), vectors in zip(calls, results):
+            # A caller that was cancelled no longer waits for its future
+            if not future.done():
+                future.set_result(vectors)
+
+    async def _asend(self, groups, tokens, enqueued, semaphore, split=False, hedge=True):
+        async with semaphore:
+            delay = self.limiter.reserve(tokens)
+            if delay:
+                await asyncio.sleep(delay)
+            texts = [text for group in groups for text in group]
+            record_embedding_batch(len(texts), [time.perf_counter() - started for started in enqueued])
+            vectors = await acall("embeddings", lambda timeout: self.embeddings.aembed_documents(texts),
+                                  EMBEDDINGS_TIMEOUT, EMBEDDINGS_HEDGE_AFTER if hedge else 0)
+        return self._split(groups, vectors) if split else vectors
+
+    # threads
+
+    def embed(self, texts, bulk=False):
+        with upstream("embeddings"):
+            if bulk:
+                with without_budget():
+                    return self._send_chunked(self._chunks(texts), hedge=False)
+            return self._embed(texts)
+
+    def _embed(self, texts):
+        # Same for threaded servers: the first caller of a batch waits for the window,
+        # or until the batch fills up, and sends it for everyone
+        tokens = sum(estimate_tokens(text) for text in texts)
+        if self._alone(texts, tokens):
+            chunks = self._chunks(texts)
+            return self._send_chunked(chunks, hedge=len(chunks) == 1)
+        with self._lock:
+            batch = self._batch
+            if batch is not None and not self._fits(batch, texts, tokens):
+                batch.full.set()
+                batch = None
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            index = len(batch.calls)
+            batch.calls.append((texts, time.perf_counter()))
+            batch.texts += len(texts)
+            batch.tokens += tokens
+            if batch.texts >= self.max_size or batch.tokens >= self.max_tokens:
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            try:
+                batch.vectors = self._send([texts for texts, _ in batch.calls], batch.tokens,
+                                           [enqueued for _, enqueued in batch.calls], split=True)
+            except Exception as e:
+                batch.error = e
+            batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.vectors[index]
+
+    def _send_chunked(self, chunks, hedge):
+        enqueued = time.perf_counter()
+        vectors = []
+        for chunk, tokens in chunks:
+            vectors.extend(self._send([chunk], tokens, [enqueued], hedge=hedge))
+        return vectors
+
+    def _send(self, groups, tokens, enqueued, split=False, hedge=True):
+        with self._slots:
+            delay = self.limiter.reserve(tokens)
+            if delay:
+                time.sleep(delay)
+            texts = [text for group in groups for text in group]
+            record_embedding_batch(len(texts), [time.perf_counter() - started for started in enqueued])
+            vectors = call("embeddings", lambda timeout: self.embeddings.embed_documents(texts),
+                           EMBEDDINGS_TIMEOUT, EMBEDDINGS_HEDGE_AFTER if hedge else 0)
+        return self._split(groups, vectors) if split else vectors
+
+    @staticmethod
+    def _split(groups, vectors):
+        results = []
+        start = 0
+        for group in groups:
+            results.append(vectors[start:start + len(group)])
+            start += len(group)
+        return results
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+from async_utils import run_blocking
+from embedding_batcher import EmbeddingBatcher
+from metrics import count_cache
+from singleflight import SingleFlight
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "/tmp/embedding_cache.sqlite3")
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+
+
+class CachedEmbeddings(Embeddings):
+    # Drop-in wrapper around any LangChain embeddings model. Vectors are stored in SQLite
+    # keyed by a hash of model + text, with an in-memory LRU in front, so a text is only
+    # ever sent to the API once. Queries and documents share the same cache entries.
+
+    def __init__(self, embeddings, path=EMBEDDING_CACHE_PATH, max_size=EMBEDDING_CACHE_SIZE):
+        self.embeddings = embeddings
+        # Misses from concurrent calls are sent to the API together, within rate limits
+        self._batcher = EmbeddingBatcher(embeddings)
+        self.model = getattr(embeddings, 'model', type(embeddings).__name__)
+        self.max_size = max_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self._db.commit()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # Identical queries arriving together are embedded by one call
+        self._queries = SingleFlight("query_embedding")
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model}\0{text}".encode('utf-8')).hexdigest()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys):
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                    self.hits += 1
+                else:
+                    missing.append(key)
+            if missing:
+                placeholders = ','.join('?' * len(missing))
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", missing
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                    self._remember(key, vector)
+                    found[key] = vector
+                    self.disk_hits += 1
+        count_cache("embeddings", "hit", len(keys) - len(missing))
+        count_cache("embeddings", "disk_hit", len(found) - (len(keys) - len(missing)))
+        return found
+
+    def _store(self, items):
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items],
+            )
+            self._db.commit()
+            for key, vector in items:
+                self._remember(key, vector)
+
+    def _partition(self, texts):
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(set(keys))
+        # De-duplicate so repeated texts in one call are embedded once
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in pending:
+                pending[key] = text
+        self.misses += len(pending)
+        count_cache("embeddings", "miss", len(pending))
+        return keys, found, pending
+
+    def _merge(self, keys, found, pending, vectors):
+        items = list(zip(pending.keys(), vectors))
+        if items:
+            self._store(items)
+            found.update(items)
+        return [found[key] for key in keys]
+
+    def embed_documents(self, texts, bulk=False):
+        # bulk=True for index builds, see EmbeddingBatcher
+        keys, found, pending = self._partition(texts)
+        vectors = []
+        if pending:
+            vectors = self._batcher.embed(list(pending.values()), bulk)
+        return self._merge(keys, found, pending, vectors)
+
+    def _memory_hit(self, key):
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+        if vector is not None:
+            count_cache("embeddings", "hit")
+        return vector
+
+    def embed_query(self, text):
+        key = self._key(text)
+        vector = self._memory_hit(key)
+        if vector is not None:
+            return vector
+        return self._queries.run_sync(key, lambda: self._embed_query(text))
+
+    def _embed_query(self, text):
+        keys, found, pending = self._partition([text])
+        vectors = []
+        if pending:
+            # Sent as a one-text document so it can share a batch; the embeddings models
+            # in use embed queries and documents the same way
+            vectors = self._batcher.embed([text])
+        return self._merge(keys, found, pending, vectors)[0]
+
+    async def aembed_documents(self, texts, bulk=False):
+        # The SQLite read and write run in the executor, off the event loop
+        keys, found, pending = await run_blocking(self._partition, texts)
+        if not pending:
+            return [found[key] for key in keys]
+        vectors = await self._batcher.aembed(list(pending.values()), bulk)
+        return await run_blocking(self._merge, keys, found, pending, vectors)
+
+    async def aembed_query(self, text):
+        key = self._key(text)
+        vector = self._memory_hit(key)
+        if vector is not None:
+            return vector
+        return await self._queries.run(key, lambda: self._aembed_query(text))
+
+    async def _aembed_query(self, text):
+        keys, found, pending = await run_blocking(self._partition, [text])
+        if not pending:
+            return found[keys[0]]
+        vectors = await self._batcher.aembed([text])
+        return (await run_blocking(self._merge, keys, found, pending, vectors))[0]
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "model": self.model,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+            "memory_entries": len(self._memory),
+        }
@@ -0,0 +1,454 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import threading
+import uuid
+
+import faiss
+import numpy as np
+
+from async_utils import run_blocking
+from metrics import count_index_rebuild, stage
+from singleflight import async_process_lock, process_lock
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'manifest.json'
+INDEX_FILE = 'index.faiss'
+
+# How vectors are encoded: flat (float32), fp16 or sq8 (8-bit scalar quantization)
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "fp16")
+# Catalogs with at least this many journeys use an IVF-PQ index instead; 0 disables it
+VECTOR_IVF_THRESHOLD = int(os.getenv("VECTOR_IVF_THRESHOLD", "100000"))
+# Inverted lists probed per IVF search; higher is slower and closer to exact
+VECTOR_IVF_NPROBE = int(os.getenv("VECTOR_IVF_NPROBE", "16"))
+# Memory-map index files so every worker process shares the same pages
+VECTOR_MMAP = os.getenv("VECTOR_MMAP", "1") != "0"
+# Published versions kept on disk, newest first. Other workers sharing the path may still
+# be serving an older version, so it is not deleted as soon as a new one is published.
+VECTOR_KEEP_VERSIONS = max(2, int(os.getenv("VECTOR_KEEP_VERSIONS", "3")))
+
+STORAGE_CODES = {'flat': 'Flat', 'fp16': 'SQfp16', 'sq8': 'SQ8'}
+VERSION_DIR = re.compile(r'^[0-9a-f]{32}$')
+
+
+def content_digest(text):
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+
+def journey_id(name):
+    # Stable positive int64 FAISS id derived from the journey name
+    return int.from_bytes(hashlib.sha256(name.encode('utf-8')).digest()[:8], 'big') & 0x7FFFFFFFFFFFFFFF
+
+
+def journey_documents(snapshot):
+    # Text embedded for each journey, keyed by Journey Name (N)
+    return {name: name for name in snapshot.journey_names}
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def storage_label(count, storage=VECTOR_STORAGE, ivf_threshold=VECTOR_IVF_THRESHOLD):
+    if storage not in STORAGE_CODES:
+        raise ValueError(f"Unknown VECTOR_STORAGE {storage!r}, expected one of {', '.join(STORAGE_CODES)}")
+    if ivf_threshold and count >= ivf_threshold:
+        return 'ivf-pq'
+    return storage
+
+
+def index_factory_string(label, count, dim):
+    if label != 'ivf-pq':
+        return STORAGE_CODES[label]
+    # About 4 * sqrt(n) inverted lists, and 4-bit fast-scan PQ codes at one byte per 8
+    # dimensions; 4-bit codebooks train in seconds where 8-bit ones take minutes
+    nlist = max(1, int(4 * math.sqrt(count)))
+    subquantizers = next(m for m in range(max(1, dim // 4), 0, -1) if dim % m == 0)
+    return f"IVF{nlist},PQ{subquantizers}x4fs"
+
+
+def build_index(vectors, ids, storage=VECTOR_STORAGE, ivf_threshold=VECTOR_IVF_THRESHOLD):
+    # Inner-product index over unit vectors in the requested encoding; returns (index, label)
+    vectors = normalize(vectors)
+    label = storage_label(len(vectors), storage, ivf_threshold)
+    index = faiss.index_factory(vectors.shape[1], index_factory_string(label, len(vectors), vectors.shape[1]),
+                                faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        index.train(vectors)
+    if label == 'ivf-pq':
+        # IVF indexes carry their own ids
+        index.nprobe = VECTOR_IVF_NPROBE
+    else:
+        index = faiss.IndexIDMap2(index)
+    index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+    return index, label
+
+
+def recall_against_flat(index, vectors, ids, queries, k=10):
+    # Share of the index's top-k that an exact search would also return. A result counts
+    # when its exact score reaches the k-th best exact score, so ties are not misses.
+    vectors, queries = normalize(vectors), normalize(queries)
+    ids = np.asarray(ids, dtype=np.int64)
+    k = min(k, len(ids))
+    if k == 0 or len(queries) == 0:
+        return None
+    exact = queries @ vectors.T
+    kth_best = -np.partition(-exact, k - 1, axis=1)[:, k - 1]
+    order = np.argsort(ids)
+    _, found = index.search(queries, k)
+    rows = order[np.searchsorted(ids, found, sorter=order).clip(0, len(ids) - 1)]
+    hits = (found != -1) & (np.take_along_axis(exact, rows, axis=1) >= kth_best[:, None] - 1e-5)
+    return round(float(hits.sum()) / (k * len(queries)), 4)
+
+
+class JourneyTable:
+    # Journey metadata as flat arrays sorted by FAISS id: one sha256 digest per journey and
+    # the names packed into a single UTF-8 buffer with offsets. Saved as .npy files and
+    # memory-mapped on load, like the index itself.
+    FILES = ('ids', 'digests', 'offsets', 'names')
+
+    def __init__(self, ids, digests, offsets, names):
+        self.ids = ids
+        self.digests = digests
+        self.offsets = offsets
+        self.names = names
+
+    @classmethod
+    def build(cls, documents):
+        names = list(documents)
+        ids = np.array([journey_id(name) for name in names], dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        encoded = [names[i].encode('utf-8') for i in order]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=offsets[1:])
+        digests = b''.join(content_digest(documents[names[i]]) for i in order)
+        return cls(
+            ids[order],
+            np.frombuffer(digests, dtype=np.uint8).reshape(-1, 32),
+            offsets,
+            np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        )
+
+    @classmethod
+    def load(cls, directory, mmap=VECTOR_MMAP):
+        return cls(*(np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r' if mmap else None)
+                     for name in cls.FILES))
+
+    def save(self, directory):
+        for name in self.FILES:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.FILES)
+
+    def positions(self, ids):
+        # Row of each id in the table, or -1 when it is not present
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(self.ids, ids)
+        clipped = np.minimum(positions, max(len(self.ids) - 1, 0))
+        found = (positions < len(self.ids)) & (self.ids[clipped] == ids) if len(self.ids) else np.zeros(len(ids), bool)
+        return np.where(found, positions, -1)
+
+    def name(self, position):
+        return bytes(self.names[self.offsets[position]:self.offsets[position + 1]]).decode('utf-8')
+
+    def diff(self, documents):
+        # Ids no longer in the catalog, and names that are new or whose text changed
+        names = list(documents)
+        ids = np.array([journey_id(name) for name in names], dtype=np.int64)
+        removed = np.setdiff1d(self.ids, ids).tolist()
+        positions = self.positions(ids)
+        changed = [name for name, position in zip(names, positions)
+                   if position == -1 or bytes(self.digests[position]) != content_digest(documents[name])]
+        return removed, changed
+
+
+class JourneyIndex:
+    # ID-mapped inner-product index over unit vectors, so scores are cosine similarities
+    # (approximate for quantized storage). Instances are never mutated once published;
+    # updates build a new version and swap it in.
+
+    def __init__(self, index, table, info, directory=None):
+        self.index = index
+        self.table = table
+        self.info = info
+        # Version directory the index was read from or written to
+        self.directory = directory
+
+    def __len__(self):
+        return self.index.ntotal
+
+    def search_many(self, vectors, k=1):
+        if self.index.ntotal == 0:
+            return [[] for _ in range(len(vectors))]
+        scores, ids = self.index.search(normalize(vectors), min(k, self.index.ntotal))
+        positions = self.table.positions(ids.ravel()).reshape(ids.shape)
+        return [
+            [(self.table.name(int(p)), float(score)) for score, p in zip(row_scores, row_positions) if p != -1]
+            for row_scores, row_positions in zip(scores, positions)
+        ]
+
+    def search(self, vector, k=1):
+        return self.search_many([vector], k)[0]
+
+    def nbytes(self):
+        # Encoded vectors plus the side table, as recorded when the version was written
+        return int((self.info.get('bytes_per_vector') or 0) * self.index.ntotal) + (self.info.get('table_bytes') or 0)
+
+    def stats(self):
+        return {
+            "journeys": self.index.ntotal,
+            "storage": self.info.get('storage'),
+            "bytes_per_vector": self.info.get('bytes_per_vector'),
+            "table_bytes": self.info.get('table_bytes'),
+            "recall_at_10": self.info.get('recall_at_10'),
+            "mmap": self.info.get('mmap', False),
+        }
+
+
+class JourneyIndexStore:
+    # Keeps a JourneyIndex in sync with the catalog. The side table stores a content digest
+    # per journey; on each new catalog snapshot only added or changed journeys are embedded
+    # and deleted ones are removed by id. Each update is written to a fresh version directory
+    # and published by atomically replacing the manifest. embeddings is a CachedEmbeddings;
+    # builds embed through its bulk path.
+
+    def __init__(self, path, embeddings, storage=VECTOR_STORAGE, ivf_threshold=VECTOR_IVF_THRESHOLD, mmap=VECTOR_MMAP):
+        self.path = path
+        self.embeddings = embeddings
+        # Vectors from different models are not comparable, so the model is part of the manifest
+        self.model = getattr(embeddings, 'model', type(embeddings).__name__)
+        self.storage = storage
+        self.ivf_threshold = ivf_threshold
+        self.mmap = mmap
+        self.current = None
+        self._synced_snapshot = None
+        self._lock = threading.Lock()
+        self._async_lock = asyncio.Lock()
+
+    def _load(self):
+        with stage("index_load"):
+            return self._read()
+
+    def _read(self):
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path) as f:
+                stored = json.load(f)
+            if stored.get('model') != self.model or 'version' not in stored:
+                logger.info("Journey index at %s was built with %s, rebuilding", self.path, stored.get('model'))
+                return None
+            return self._read_version(stored)
+        except Exception as e:
+            logger.warning("Ignoring unreadable journey index at %s: %s", self.path, e)
+            return None
+
+    def _read_version(self, info):
+        directory = os.path.join(self.path, info['version'])
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if self.mmap else 0
+        index = faiss.read_index(os.path.join(directory, INDEX_FILE), flags)
+        return JourneyIndex(index, JourneyTable.load(directory, self.mmap), dict(info, mmap=self.mmap), directory)
+
+    def _save(self, index, table, info):
+        version = uuid.uuid4().hex
+        directory = os.path.join(self.path, version)
+        os.makedirs(directory)
+        index_path = os.path.join(directory, INDEX_FILE)
+        faiss.write_index(index, index_path)
+        table.save(directory)
+        info = dict(
+            info,
+            version=version,
+            model=self.model,
+            journeys=index.ntotal,
+            bytes_per_vector=round(os.path.getsize(index_path) / index.ntotal, 1) if index.ntotal else None,
+            table_bytes=table.nbytes(),
+        )
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        tmp_path = f"{manifest_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmp_path, manifest_path)
+        self._prune(version)
+        return info
+
+    def _prune(self, version):
+        # Deletes all but the VECTOR_KEEP_VERSIONS newest versions, never the one just
+        # published or the one this store serves. Updates start from the index in memory,
+        # so a worker whose version is pruned keeps working; mapped pages stay valid until
+        # it moves on.
+        keep = {version}
+        if self.current is not None and self.current.directory:
+            keep.add(os.path.basename(self.current.directory))
+        versions = []
+        for name in os.listdir(self.path):
+            old_path = os.path.join(self.path, name)
+            try:
+                if VERSION_DIR.match(name):
+                    versions.append((os.path.getmtime(old_path), name))
+                elif name.startswith('index-') and name.endswith('.faiss'):
+                    os.remove(old_path)
+            except OSError:
+                pass
+        versions.sort(reverse=True)
+        keep.update(name for _, name in versions[:VECTOR_KEEP_VERSIONS])
+        for _, name in versions:
+            if name not in keep:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def _diff(self, base, documents):
+        if base is None:
+            return [], list(documents)
+        if not len(base):
+            # The empty placeholder has no encoding or dimension to update
+            return None, list(documents)
+        expected = storage_label(len(documents), self.storage, self.ivf_threshold)
+        if base.info.get('storage') != expected:
+            # Encoding changed (config or IVF threshold crossed); rebuilding re-reads the
+            # vectors from the embedding cache rather than the embeddings API
+            logger.info("Journey index storage changing from %s to %s, rebuilding", base.info.get('storage'), expected)
+            return None, list(documents)
+        return base.table.diff(documents)
+
+    def _apply(self, base, documents, removed, changed, vectors):
+        # removed is None for a full rebuild, otherwise the ids to drop from base
+        table = JourneyTable.build(documents)
+        if base is None or removed is None:
+            if not changed:
+                # An empty catalog: searches find nothing until journeys are added
+                return JourneyIndex(faiss.IndexIDMap(faiss.IndexFlatIP(1)), table, {'storage': None})
+            ids = [journey_id(name) for name in changed]
+            index, label = build_index(vectors, ids, self.storage, self.ivf_threshold)
+            info = {'storage': label, 'dim': index.d}
+            if label != 'flat':
+                sample = np.random.default_rng(0).choice(len(ids), min(100, len(ids)), replace=False)
+                info['recall_at_10'] = recall_against_flat(index, vectors, ids, np.asarray(vectors)[sample])
+        else:
+            # Mapped indexes are read-only, so updates start from a private in-memory copy.
+            # Its file may be gone (pruned by another worker) or read-only (a bundle).
+            index = faiss.clone_index(base.index)
+            stale_ids = removed + [journey_id(name) for name in changed]
+            if stale_ids:
+                index.remove_ids(np.array(stale_ids, dtype=np.int64))
+            if changed:
+                index.add_with_ids(normalize(vectors), np.array([journey_id(name) for name in changed], dtype=np.int64))
+            info = {key: base.info[key] for key in ('storage', 'dim', 'recall_at_10') if key in base.info}
+        info = self._save(index, table, info)
+        count_index_rebuild()
+        logger.info("Journey index updated: %d embedded, %d removed, %s storage at %s bytes/vector",
+                    len(changed), len(removed or []), info['storage'], info['bytes_per_vector'])
+        if self.mmap:
+            # Swap the private copy for the shared mapping of the file just written
+            return self._read_version(info)
+        return JourneyIndex(index, table, dict(info, mmap=False), os.path.join(self.path, info['version']))
+
+    def load(self):
+        # Index currently published at path, or None; nothing is embedded or written
+        return self._load()
+
+    def seed(self, snapshot, journey_index):
+        # Serve a prebuilt index for this snapshot; later snapshots sync on top of it
+        if self.current is None:
+            self._publish(snapshot, journey_index)
+
+    def unload(self):
+        # Drop the served index. The next get() reads the published version back from path,
+        # or rebuilds it from the embedding cache when none was written there.
+        with self._lock:
+            self._synced_snapshot = None
+            self.current = None
+
+    def _stale(self):
+        # True when there is nothing loaded yet, or when the manifest names another version
+        # than the one being served because a different worker published in the meantime
+        current = self.current
+        if current is None:
+            return True
+        try:
+            with open(os.path.join(self.path, MANIFEST_FILE)) as f:
+                version = json.load(f).get('version')
+        except (OSError, ValueError):
+            return False
+        return version not in (None, current.info.get('version'))
+
+    def _publish(self, snapshot, updated):
+        # Publishing is a single reference assignment, so searches see the old or new index
+        self.current = updated
+        self._synced_snapshot = snapshot
+        return updated
+
+    def _prepare(self, snapshot):
+        # Version to update from and what changed since it; reads the manifest and hashes
+        # every journey, so the async path runs it in the executor
+        base = self.current
+        if self._stale():
+            base = self._load() or base
+        documents = journey_documents(snapshot)
+        removed, changed = self._diff(base, documents)
+        return base, documents, removed, changed
+
+    def sync(self, snapshot):
+        with self._lock:
+            if self._synced_snapshot is snapshot and self.current is not None:
+                return self.current
+            # Versions are immutable and the served ones are never pruned, so worker processes
+            # sharing the path may build at once; each starts from the newest published version.
+            # With SINGLEFLIGHT_FILE_LOCK=1 they build one at a time and skip duplicate work.
+            with process_lock("index", self.path):
+                base, documents, removed, changed = self._prepare(snapshot)
+                if not removed and not changed and base is not None:
+                    return self._publish(snapshot, base)
+                vectors = self.embeddings.embed_documents([documents[name] for name in changed], bulk=True) if changed else []
+                with stage("index_build"):
+                    updated = self._apply(base, documents, removed, changed, vectors)
+                return self._publish(snapshot, updated)
+
+    async def async_sync(self, snapshot):
+        # Same as sync, but embeds through the async API and runs FAISS and file work in the
+        # bounded executor so the event loop stays free
+        async with self._async_lock:
+            if self._synced_snapshot is snapshot and self.current is not None:
+                return self.current
+            async with async_process_lock("index", self.path):
+                base, documents, removed, changed = await run_blocking(self._prepare, snapshot)
+                if not removed and not changed and base is not None:
+                    return self._publish(snapshot, base)
+                vectors = await self.embeddings.aembed_documents([documents[name] for name in changed], bulk=True) if changed else []
+                with stage("index_build"):
+                    updated = await run_blocking(self._apply, base, documents, removed, changed, vectors)
+                return self._publish(snapshot, updated)
+
+    def get(self, snapshot):
+        current = self.current
+        if current is not None:
+            if self._synced_snapshot is snapshot:
+                return current
+            # Another request is already syncing; keep serving the previous index meanwhile
+            if self._lock.locked():
+                return current
+        return self.sync(snapshot)
+
+    async def aget(self, snapshot):
+        current = self.current
+        if current is not None:
+            if self._synced_snapshot is snapshot:
+                return current
+            if self._async_lock.locked():
+                return current
+        return await self.async_sync(snapshot)
@@ -0,0 +1,154 @@
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+
+from async_utils import run_blocking
+from metrics import stage
+
+# Local matching on journey names before any embedding call; 0 disables it
+LEXICAL_MATCH = os.getenv("LEXICAL_MATCH", "1") != "0"
+# A lexical top hit at or above this confidence, with at least LEXICAL_MARGIN lead over the
+# runner-up, answers without embedding the query
+LEXICAL_ACCEPT = float(os.getenv("LEXICAL_ACCEPT", "0.85"))
+LEXICAL_MARGIN = float(os.getenv("LEXICAL_MARGIN", "0.1"))
+# Below LEXICAL_ACCEPT but at or above this, lexical and vector scores are fused
+LEXICAL_FUSE = float(os.getenv("LEXICAL_FUSE", "0.4"))
+# Share of the lexical score in a fused score
+LEXICAL_WEIGHT = float(os.getenv("LEXICAL_WEIGHT", "0.5"))
+# Candidates compared on each side when fusing
+FUSION_CANDIDATES = 10
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Paths that resolve a query without an embedding
+CONFIDENT_PATHS = ('exact', 'lexical')
+
+
+def normalize_query(text):
+    return re.sub(r'[^\w]+', ' ', text.lower()).strip()
+
+
+def word_trigrams(words):
+    return [f" {word} "[i:i + 3] for word in words for i in range(len(word))]
+
+
+def name_trigrams(normalized):
+    return set(word_trigrams(normalized.split()))
+
+
+def dice(a, b):
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def fuse_scores(lexical_matches, vector_matches, weight=LEXICAL_WEIGHT):
+    scores = {}
+    for name, score in lexical_matches:
+        scores[name] = weight * score
+    for name, score in vector_matches:
+        scores[name] = scores.get(name, 0.0) + (1 - weight) * score
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class LexicalIndex:
+    # BM25 over the words and word trigrams of each journey's name (counted twice) and
+    # agenda items, so typos still share terms. BM25 only proposes candidates; their
+    # confidence is the trigram Dice similarity between the query and the journey name.
+
+    def __init__(self, snapshot):
+        self.names = list(snapshot.journey_names)
+        self.exact = {}
+        self.trigrams = []
+        documents = []
+        for name in self.names:
+            normalized = normalize_query(name)
+            self.exact.setdefault(normalized, name)
+            self.trigrams.append(name_trigrams(normalized))
+            agenda = ' '.join(snapshot.agenda_by_journey.get(name, []))
+            words = normalize_query(f"{name} {name} {agenda}").split()
+            documents.append(Counter(words + word_trigrams(words)))
+        self._build_postings(documents)
+
+    def _build_postings(self, documents):
+        # Per-term arrays of (journey, BM25 weight); a query score is a sum of weights
+        lengths = np.array([sum(terms.values()) for terms in documents], dtype=np.float32)
+        average = float(lengths.mean()) if len(lengths) else 1.0
+        postings = {}
+        for doc, terms in enumerate(documents):
+            for term, tf in terms.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(doc)
+                postings[term][1].append(tf)
+        count = len(documents)
+        self.postings = {}
+        for term, (docs, tfs) in postings.items():
+            docs = np.array(docs, dtype=np.int32)
+            tfs = np.array(tfs, dtype=np.float32)
+            idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[docs] / average)
+            self.postings[term] = (docs, (idf * tfs * (BM25_K1 + 1) / (tfs + norm)).astype(np.float32))
+
+    def search(self, query, k=FUSION_CANDIDATES):
+        # [(journey name, confidence)] best first; an exact normalized name scores 1.0
+        normalized = normalize_query(query)
+        if normalized in self.exact:
+            return [(self.exact[normalized], 1.0)]
+        words = normalized.split()
+        scores = np.zeros(len(self.names), dtype=np.float32)
+        for term in set(words + word_trigrams(words)):
+            if term in self.postings:
+                docs, weights = self.postings[term]
+                scores[docs] += weights
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > 2 * k:
+            candidates = candidates[np.argpartition(-scores[candidates], 2 * k)[:2 * k]]
+        query_trigrams = name_trigrams(normalized)
+        ranked = sorted(((dice(query_trigrams, self.trigrams[doc]), float(scores[doc]), doc) for doc in candidates),
+                        reverse=True)
+        return [(self.names[doc], round(confidence, 4)) for confidence, _, doc in ranked[:k]]
+
+    def classify(self, query):
+        # (path, matches): exact or lexical answer the query on their own, fused needs the
+        # vector search to break the tie, vector means the lexical side found nothing useful
+        matches = self.search(query)
+        if not matches:
+            return 'vector', []
+        top = matches[0][1]
+        runner_up = matches[1][1] if len(matches) > 1 else 0.0
+        if top >= 1.0 and len(matches) == 1:
+            return 'exact', matches
+        if top >= LEXICAL_ACCEPT and top - runner_up >= LEXICAL_MARGIN:
+            return 'lexical', matches
+        if top >= LEXICAL_FUSE:
+            return 'fused', matches
+        return 'vector', matches
+
+
+class LexicalMatcher:
+    # Keeps a LexicalIndex built for the current catalog snapshot
+
+    def __init__(self):
+        self._snapshot = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get(self, snapshot):
+        if self._snapshot is snapshot:
+            return self._index
+        with self._lock:
+            if self._snapshot is not snapshot:
+                with stage("lexical_build"):
+                    index = LexicalIndex(snapshot)
+                self._index, self._snapshot = index, snapshot
+            return self._index
+
+    async def aget(self, snapshot):
+        if self._snapshot is snapshot:
+            return self._index
+        return await run_blocking(self.get, snapshot)
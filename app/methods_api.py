@@ -0,0 +1,190 @@
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+from collections import OrderedDict
+
+from metrics import count_cache, stage
+
+# GET /methods: the methods -> alternatives table of the catalog, so the frontend no
+# longer downloads and groups the whole sheet itself
+METHODS_PAGE_SIZE = int(os.getenv("METHODS_PAGE_SIZE", "100"))
+METHODS_MAX_PAGE_SIZE = int(os.getenv("METHODS_MAX_PAGE_SIZE", "1000"))
+# Seconds clients and proxies may reuse a response before revalidating it
+METHODS_MAX_AGE = int(os.getenv("METHODS_MAX_AGE", "60"))
+# Bodies smaller than this are sent uncompressed
+METHODS_GZIP_MIN_BYTES = int(os.getenv("METHODS_GZIP_MIN_BYTES", "1024"))
+
+METHOD_FIELDS = ('method', 'alternatives', 'description', 'ai_response')
+DEFAULT_FIELDS = ('method', 'alternatives', 'description')
+# Encoded bodies kept per ETag
+BODY_CACHE_SIZE = 256
+
+
+def parse_int(params, name, default, minimum=0, maximum=None):
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer")
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(f"{name} must be between {minimum} and {maximum}" if maximum is not None
+                         else f"{name} must be at least {minimum}")
+    return value
+
+
+def parse_query(params):
+    # (fields, sample, seed, offset, limit) from the query string; ValueError on bad input
+    fields = params.get('fields')
+    if fields:
+        fields = tuple(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip()))
+        unknown = [field for field in fields if field not in METHOD_FIELDS]
+        if unknown or not fields:
+            raise ValueError(f"fields must be a subset of {', '.join(METHOD_FIELDS)}")
+    else:
+        fields = DEFAULT_FIELDS
+    sample = parse_int(params, 'sample', None, minimum=1)
+    seed = parse_int(params, 'seed', None)
+    offset = parse_int(params, 'offset', 0)
+    limit = parse_int(params, 'limit', METHODS_PAGE_SIZE, minimum=1, maximum=METHODS_MAX_PAGE_SIZE)
+    return fields, sample, seed, offset, limit
+
+
+def methods_page(rows, fields, sample, seed, offset, limit):
+    # A sample is a random subset in random order, paginated like the full table
+    if sample is not None:
+        rows = random.Random(seed).sample(rows, min(sample, len(rows)))
+    page = rows[offset:offset + limit]
+    body = {
+        "methods": [{field: row[field] for field in fields} for row in page],
+        "total": len(rows),
+        "offset": offset,
+        "limit": limit,
+        "next_offset": offset + limit if offset + limit < len(rows) else None,
+    }
+    if sample is not None:
+        body["seed"] = seed
+    return body
+
+
+def etag_matches(if_none_match, etag):
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+
+
+def accepts_gzip(accept_encoding):
+    # RFC 9110 content negotiation: gzip, or *, with a non-zero q-value. An explicit
+    # gzip entry wins over *.
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    quality = qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0.0)))
+    return quality > 0
+
+
+def gzip_etag(etag):
+    # Strong ETags are per representation, so the gzipped body gets its own
+    return etag[:-1] + '-gz"'
+
+
+class MethodsEndpoint:
+    # Bodies are encoded (and gzipped) once per catalog content and query, and served
+    # from memory until the table changes. A sample without a seed gets a fresh random
+    # seed per request and is neither cached nor given an ETag.
+
+    def __init__(self):
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _encode(self, rows, query):
+        body = json.dumps(methods_page(rows, *query), separators=(',', ':')).encode('utf-8')
+        compressed = gzip.compress(body, compresslevel=6) if len(body) >= METHODS_GZIP_MIN_BYTES else None
+        return body, compressed
+
+    def _cached(self, etag):
+        with self._lock:
+            encoded = self._bodies.get(etag)
+            if encoded is not None:
+                self._bodies.move_to_end(etag)
+        return encoded
+
+    def _remember(self, etag, encoded):
+        with self._lock:
+            self._bodies[etag] = encoded
+            while len(self._bodies) > BODY_CACHE_SIZE:
+                self._bodies.popitem(last=False)
+
+    def respond(self, snapshot, params, headers):
+        # (status, body bytes, headers), or raises ValueError for a bad query
+        query = parse_query(params)
+        fields, sample, seed, offset, limit = query
+        rows, digest = snapshot.method_table()
+        response_headers = {"Vary": "Accept-Encoding"}
+        if sample is not None and seed is None:
+            query = (fields, sample, random.randrange(2 ** 31), offset, limit)
+            encoded, etag = self._encode(rows, query), None
+            response_headers["Cache-Control"] = "no-store"
+        else:
+            key = json.dumps([digest, list(fields), sample, seed, offset, limit])
+            etag = '"' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:32] + '"'
+            response_headers["Cache-Control"] = f"public, max-age={METHODS_MAX_AGE}"
+            if_none_match = headers.get('if-none-match')
+            for variant in (etag, gzip_etag(etag)):
+                if etag_matches(if_none_match, variant):
+                    count_cache("methods", "not_modified")
+                    response_headers["ETag"] = variant
+                    return 304, b'', response_headers
+            encoded = self._cached(etag)
+            count_cache("methods", "hit" if encoded is not None else "miss")
+            if encoded is None:
+                with stage("methods_encode"):
+                    encoded = self._encode(rows, query)
+                self._remember(etag, encoded)
+        body, compressed = encoded
+        if compressed is not None and accepts_gzip(headers.get('accept-encoding')):
+            response_headers["Content-Encoding"] = "gzip"
+            body = compressed
+            if etag is not None:
+                etag = gzip_etag(etag)
+        if etag is not None:
+            response_headers["ETag"] = etag
+        return 200, body, response_headers
+
+
+def install_fastapi(app, registry):
+    # GET /methods?fields=method,alternatives&sample=5&seed=42&offset=0&limit=100&catalog=acme
+    from fastapi import HTTPException, Request, Response
+
+    endpoint = MethodsEndpoint()
+
+    @app.get("/methods")
+    async def methods(request: Request):
+        snapshot = await registry.resolve(request.query_params, request.headers).catalog.aget()
+        try:
+            # Inline: only the first request per catalog content and query encodes anything
+            status, body, headers = endpoint.respond(snapshot, request.query_params, request.headers)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return Response(body, status_code=status, media_type="application/json" if status == 200 else None,
+                        headers=headers)
+
+    return endpoint
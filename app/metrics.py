@@ -0,0 +1,190 @@
+import contextvars
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+logger = logging.getLogger(__name__)
+
+# Requests slower than this many milliseconds log their full stage breakdown; unset disables it
+SLOW_REQUEST_MS = os.getenv("SLOW_REQUEST_MS")
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_SECONDS = Histogram("compass_request_seconds", "End-to-end request latency", ["app", "path"], buckets=BUCKETS)
+STAGE_SECONDS = Histogram("compass_stage_seconds", "Latency of one request stage", ["stage"], buckets=BUCKETS)
+UPSTREAM_ERRORS = Counter("compass_upstream_errors_total", "Failed calls to an upstream service", ["upstream"])
+CACHE_EVENTS = Counter("compass_cache_events_total", "Cache lookups by outcome", ["cache", "result"])
+INDEX_REBUILDS = Counter("compass_index_rebuilds_total", "Journey index builds and incremental updates")
+SINGLEFLIGHT_CALLS = Counter("compass_singleflight_total", "Single-flight calls that computed (leader) or waited (shared)",
+                             ["flight", "role"])
+EMBEDDING_BATCH_TEXTS = Histogram("compass_embedding_batch_size", "Texts per embeddings API request",
+                                  buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048))
+EMBEDDING_QUEUE_WAIT = Histogram("compass_embedding_queue_wait_seconds",
+                                 "Time an embedding call waited for its batch to be sent", buckets=BUCKETS)
+CIRCUIT_STATE = Gauge("compass_circuit_state", "Circuit breaker state per upstream: 0 closed, 1 half-open, 2 open",
+                      ["upstream"])
+HEDGED_CALLS = Counter("compass_hedged_calls_total", "Hedged upstream calls by the attempt that answered",
+                       ["upstream", "winner"])
+DEGRADED_RESPONSES = Counter("compass_degraded_responses_total", "Responses sent without a failed or slow stage",
+                             ["stage", "reason"])
+LLM_TOKENS = Histogram("compass_llm_tokens", "Tokens per LLM call", ["kind"],
+                       buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192))
+CATALOG_INDEX_BYTES = Gauge("compass_catalog_index_bytes", "Memory held by each catalog's loaded vector index, 0 when unloaded",
+                            ["catalog"])
+CATALOG_INDEX_LOOKUPS = Counter("compass_catalog_index_total",
+                                "Catalog index lookups that found it loaded (hit) or had to load it (miss), and evictions",
+                                ["catalog", "result"])
+MATCH_PATHS = Counter("compass_match_path_total", "Journey matches by the path that answered them", ["path"])
+STARTUP_SECONDS = Gauge("compass_startup_seconds", "Time spent in each startup phase", ["phase"])
+
+# Stages recorded during the current request, as (name, seconds)
+_request_stages = contextvars.ContextVar("request_stages", default=None)
+
+
+def record_stage(name, seconds):
+    STAGE_SECONDS.labels(stage=name).observe(seconds)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages.append((name, seconds))
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def count_upstream_error(upstream):
+    UPSTREAM_ERRORS.labels(upstream=upstream).inc()
+
+
+@contextmanager
+def upstream(name):
+    # Times a call to an upstream service as a stage and counts its failures
+    with stage(name):
+        try:
+            yield
+        except Exception:
+            count_upstream_error(name)
+            raise
+
+
+def count_cache(cache, result, amount=1):
+    if amount:
+        CACHE_EVENTS.labels(cache=cache, result=result).inc(amount)
+
+
+def count_index_rebuild():
+    INDEX_REBUILDS.inc()
+
+
+def count_singleflight(flight, role):
+    SINGLEFLIGHT_CALLS.labels(flight=flight, role=role).inc()
+
+
+def record_embedding_batch(size, waits):
+    EMBEDDING_BATCH_TEXTS.observe(size)
+    for seconds in waits:
+        EMBEDDING_QUEUE_WAIT.observe(seconds)
+
+
+CIRCUIT_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+def set_circuit_state(upstream, state):
+    CIRCUIT_STATE.labels(upstream=upstream).set(CIRCUIT_STATES[state])
+
+
+def count_hedge(upstream, winner):
+    HEDGED_CALLS.labels(upstream=upstream, winner=winner).inc()
+
+
+def count_degraded(stage, reason):
+    DEGRADED_RESPONSES.labels(stage=stage, reason=reason).inc()
+
+
+def record_tokens(prompt, completion):
+    LLM_TOKENS.labels(kind="prompt").observe(prompt)
+    LLM_TOKENS.labels(kind="completion").observe(completion)
+
+
+def set_catalog_index_bytes(catalog, nbytes):
+    CATALOG_INDEX_BYTES.labels(catalog=catalog).set(nbytes)
+
+
+def count_catalog_index(catalog, result):
+    CATALOG_INDEX_LOOKUPS.labels(catalog=catalog, result=result).inc()
+
+
+def count_match_path(path):
+    MATCH_PATHS.labels(path=path).inc()
+
+
+def record_startup(phases):
+    for name, seconds in phases.items():
+        STARTUP_SECONDS.labels(phase=name).set(seconds)
+
+
+def _begin_request():
+    return _request_stages.set([]), time.perf_counter()
+
+
+def _end_request(token, started, app_name, path):
+    total = time.perf_counter() - started
+    stages = _request_stages.get() or []
+    _request_stages.reset(token)
+    REQUEST_SECONDS.labels(app=app_name, path=path).observe(total)
+
+    # Repeated stages (e.g. two sheet fetches) are summed into one Server-Timing entry
+    durations = {}
+    for name, seconds in stages:
+        durations[name] = durations.get(name, 0) + seconds
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    if SLOW_REQUEST_MS and total * 1000 > float(SLOW_REQUEST_MS):
+        breakdown = ', '.join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in stages)
+        logger.warning("Slow request %s %s took %.1fms: %s", app_name, path, total * 1000, breakdown)
+    return ', '.join(entries)
+
+
+def install_fastapi(app, app_name):
+    from fastapi import Response
+
+    @app.middleware("http")
+    async def server_timing(request, call_next):
+        token, started = _begin_request()
+        try:
+            response = await call_next(request)
+        except Exception:
+            _end_request(token, started, app_name, request.url.path)
+            raise
+        response.headers["Server-Timing"] = _end_request(token, started, app_name, request.url.path)
+        return response
+
+    @app.get("/metrics")
+    async def metrics():
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def install_flask(app, app_name):
+    from flask import Response, g, request
+
+    @app.before_request
+    def begin_timing():
+        g.timing = _begin_request()
+
+    @app.after_request
+    def server_timing(response):
+        token, started = g.pop('timing')
+        response.headers["Server-Timing"] = _end_request(token, started, app_name, request.path)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,94 @@
+import json
+import os
+import random
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+import uvicorn
+
+# Local stand-in for the opensheet and gs.jasonaa.me endpoints. Serves a JSON file with
+# {"journeys": [...], "methods": [...]} when MOCK_SHEETS_FILE is set, otherwise a
+# synthetic catalog of MOCK_SHEETS_JOURNEYS journeys.
+MOCK_SHEETS_FILE = os.getenv("MOCK_SHEETS_FILE")
+MOCK_SHEETS_JOURNEYS = int(os.getenv("MOCK_SHEETS_JOURNEYS", "200"))
+MOCK_SHEETS_METHODS = int(os.getenv("MOCK_SHEETS_METHODS", "100"))
+MOCK_SHEETS_PORT = int(os.getenv("MOCK_SHEETS_PORT", "8001"))
+
+ADJECTIVES = ["Strategic", "Customer", "Product", "Team", "Brand", "Digital", "Growth", "Innovation",
+              "Leadership", "Service", "Market", "Culture", "Vision", "Data", "Partner", "Launch"]
+NOUNS = ["Planning", "Discovery", "Alignment", "Workshop", "Roadmap", "Kickoff", "Retrospective",
+         "Ideation", "Offsite", "Review", "Sprint", "Summit", "Strategy", "Onboarding", "Research"]
+VERBS = ["Map", "Prioritize", "Sketch", "Vote on", "Share", "Define", "Frame", "Test", "Review", "Align on"]
+OBJECTS = ["goals", "stakeholders", "risks", "ideas", "customer needs", "next steps", "assumptions",
+           "success metrics", "opportunities", "constraints"]
+
+
+def generate_catalog(journeys=MOCK_SHEETS_JOURNEYS, methods=MOCK_SHEETS_METHODS, agenda_items=3, seed=42):
+    # Rows shaped like the real sheets: one journey row per agenda item, and one methods row per Uniques
+    rng = random.Random(seed)
+    method_names = [f"{rng.choice(VERBS)} {rng.choice(OBJECTS)} {i}" for i in range(methods)]
+    method_rows = [{
+        'Uniques': name,
+        'Alt 1': f"{name} (alt 1)",
+        'Alt 2': f"{name} (alt 2)",
+        'Alt 3': f"{name} (alt 3)",
+        'Description (short)': f"Use {name.lower()} to move the session forward.",
+        'AI Response': f"Try {name.lower()} with the group.",
+    } for name in method_names]
+
+    journey_rows = []
+    for i in range(journeys):
+        name = f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {i}"
+        for _ in range(agenda_items):
+            journey_rows.append({
+                'Journey Name (N)': name,
+                'Agenda Items (Description)': f"{rng.choice(VERBS)} {rng.choice(OBJECTS)}",
+                'Methods (N)': '; '.join(rng.sample(method_names, min(2, len(method_names)))),
+            })
+    return {'journeys': journey_rows, 'methods': method_rows}
+
+
+def published_rows(catalog):
+    # The published workbook carries journey and method columns side by side
+    rows = []
+    for i in range(max(len(catalog['journeys']), len(catalog['methods']))):
+        row = {}
+        if i < len(catalog['journeys']):
+            row.update(catalog['journeys'][i])
+        if i < len(catalog['methods']):
+            row.update(catalog['methods'][i])
+        rows.append(row)
+    return rows
+
+
+def load_catalog():
+    if MOCK_SHEETS_FILE:
+        with open(MOCK_SHEETS_FILE) as f:
+            return json.load(f)
+    return generate_catalog()
+
+
+def create_app(catalog=None):
+    catalog = catalog or load_catalog()
+    published = published_rows(catalog)
+    app = FastAPI()
+
+    # gs.jasonaa.me style: /?url=<published sheet url>
+    @app.get("/")
+    async def published_sheet(url: str = ''):
+        return JSONResponse(published)
+
+    # opensheet style: /<spreadsheet id>/<sheet>; gid 5 is journeys and gid 6 is methods
+    @app.get("/{spreadsheet_id}/{sheet}")
+    async def opensheet(spreadsheet_id: str, sheet: str):
+        if sheet == '5':
+            return JSONResponse(catalog['journeys'])
+        if sheet == '6':
+            return JSONResponse(catalog['methods'])
+        return JSONResponse(published)
+
+    return app
+
+
+if __name__ == "__main__":
+    uvicorn.run(create_app(), host="0.0.0.0", port=MOCK_SHEETS_PORT)
@@ -0,0 +1,103 @@
+import functools
+import logging
+import os
+
+from lexical import dice, name_trigrams, normalize_query
+from metrics import record_tokens
+
+logger = logging.getLogger(__name__)
+
+# Token budget for the whole prompt (template, recipe name and agenda items). Agenda
+# items that do not fit are dropped, least relevant to the recipe name first.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "600"))
+# Longer agenda items are cut to this many tokens
+PROMPT_ITEM_MAX_TOKENS = int(os.getenv("PROMPT_ITEM_MAX_TOKENS", "60"))
+# max_tokens of the completion
+COMPLETION_MAX_TOKENS = int(os.getenv("COMPLETION_MAX_TOKENS", "300"))
+PROMPT_MODEL = os.getenv("PROMPT_MODEL", "gpt-4")
+
+ITEM_SEPARATOR = ', '
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model=PROMPT_MODEL):
+    # One encoder per process. tiktoken downloads its BPE file on first use; without it
+    # (offline, no cache) counts fall back to an estimate.
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:
+        logger.warning("tiktoken unavailable, estimating token counts: %s", e)
+        return None
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1 if text else 0
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text, limit):
+    encoding = get_encoding()
+    if encoding is None:
+        return text if len(text) <= limit * 4 else text[:limit * 4].rstrip() + '…'
+    tokens = encoding.encode(text)
+    if len(tokens) <= limit:
+        return text
+    return encoding.decode(tokens[:limit]).rstrip() + '…'
+
+
+def rank_items(items, query):
+    # Positions of items, most relevant first: trigram similarity to the query, then
+    # sheet order, so earlier steps win ties
+    query_trigrams = name_trigrams(normalize_query(query))
+    scores = [dice(query_trigrams, name_trigrams(normalize_query(item))) for item in items]
+    return sorted(range(len(items)), key=lambda i: (-scores[i], i))
+
+
+class PromptPlan:
+    def __init__(self, inputs, text, prompt_tokens, items_total, items_kept, items_truncated):
+        self.inputs = inputs
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        self.items_total = items_total
+        self.items_kept = items_kept
+        self.items_truncated = items_truncated
+
+    def usage(self, completion=None):
+        usage = {
+            "prompt_tokens": self.prompt_tokens,
+            "prompt_budget": PROMPT_TOKEN_BUDGET,
+            "max_completion_tokens": COMPLETION_MAX_TOKENS,
+            "agenda_items": {"total": self.items_total, "kept": self.items_kept, "truncated": self.items_truncated},
+            "estimated": get_encoding() is None,
+        }
+        if completion is not None:
+            usage["completion_tokens"] = count_tokens(completion)
+        return usage
+
+    def record(self, completion):
+        # Only for completions the LLM actually generated, not cached or shared ones
+        record_tokens(self.prompt_tokens, count_tokens(completion))
+
+
+def build_prompt(template, agenda_items, inputs, query, budget=PROMPT_TOKEN_BUDGET):
+    # Fills template with inputs plus as many agenda_items as fit in budget. Kept items
+    # stay in sheet order; at least one is always kept so the answer has something to say.
+    base_tokens = count_tokens(template.format(agenda_items='', **inputs))
+    items = [truncate_tokens(item, PROMPT_ITEM_MAX_TOKENS) for item in agenda_items]
+    truncated = sum(1 for item, original in zip(items, agenda_items) if item != original)
+    separator_tokens = count_tokens(ITEM_SEPARATOR)
+    left = budget - base_tokens
+    kept = []
+    for i in rank_items(items, query):
+        cost = count_tokens(items[i]) + (separator_tokens if kept else 0)
+        if kept and cost > left:
+            continue
+        kept.append(i)
+        left -= cost
+    kept.sort()
+    filled = dict(inputs, agenda_items=ITEM_SEPARATOR.join(items[i] for i in kept))
+    text = template.format(**filled)
+    return PromptPlan(filled, text, count_tokens(text), len(items), len(kept), truncated)
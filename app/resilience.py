@@ -0,0 +1,312 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from metrics import count_degraded, count_hedge, set_circuit_state
+
+logger = logging.getLogger(__name__)
+
+# Seconds a request may take end to end; every upstream call gets at most what is left
+REQUEST_BUDGET = float(os.getenv("REQUEST_BUDGET", "30"))
+# Per-call caps in seconds, applied within the request budget
+SHEETS_TIMEOUT = float(os.getenv("SHEETS_TIMEOUT", "10"))
+EMBEDDINGS_TIMEOUT = float(os.getenv("EMBEDDINGS_TIMEOUT", "10"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "20"))
+# Idempotent calls still running after this many seconds get a second, hedged attempt;
+# the first answer wins. 0 disables hedging.
+SHEETS_HEDGE_AFTER = float(os.getenv("SHEETS_HEDGE_AFTER", "2"))
+EMBEDDINGS_HEDGE_AFTER = float(os.getenv("EMBEDDINGS_HEDGE_AFTER", "2"))
+# Consecutive failures that open an upstream's circuit, and seconds before a trial call
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))
+# Threads per upstream for blocking calls, so a hung call can be abandoned at its deadline.
+# Each upstream has its own pool: hung LLM calls cannot starve sheet or embedding calls.
+UPSTREAM_THREADS = int(os.getenv("UPSTREAM_THREADS", "8"))
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+# Monotonic deadline of the current request, None outside of requests
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+@contextmanager
+def request_budget(seconds=REQUEST_BUDGET):
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def clear_budget():
+    # For background work started from a request, which should not inherit its deadline
+    _deadline.set(None)
+
+
+@contextmanager
+def without_budget():
+    # Work inside a request that may outlast its budget, e.g. embedding a whole catalog
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left(cap):
+    # Seconds a call may take: its cap, or less when the request budget runs out first
+    deadline = _deadline.get()
+    if deadline is None:
+        return cap
+    left = min(cap, deadline - time.monotonic())
+    if left <= 0:
+        raise DeadlineExceeded("Request budget exhausted")
+    return left
+
+
+class CircuitBreaker:
+    # closed: calls go through. open: calls fail at once with CircuitOpen until `reset`
+    # seconds have passed. half-open: one trial call decides whether it closes again.
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.state = 'closed'
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        set_circuit_state(name, self.state)
+
+    def _set(self, state):
+        self.state = state
+        set_circuit_state(self.name, state)
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset:
+                self._set('half_open')
+                return
+            raise CircuitOpen(f"{self.name} circuit is open")
+
+    def success(self):
+        with self._lock:
+            self._consecutive = 0
+            if self.state != 'closed':
+                self._set('closed')
+
+    def failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self.state == 'half_open' or self._consecutive >= self.failures:
+                if self.state != 'open':
+                    logger.warning("Opening %s circuit after %d failures", self.name, self._consecutive)
+                self._opened_at = time.monotonic()
+                self._set('open')
+
+    def abandon(self):
+        # A call that was cancelled (client gone, stream closed) says nothing about the
+        # upstream. If it was the half-open trial, the circuit opens again for another
+        # `reset` seconds instead of waiting forever for the trial's outcome.
+        with self._lock:
+            if self.state == 'half_open':
+                self._opened_at = time.monotonic()
+                self._set('open')
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name):
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def executor(name):
+    with _executors_lock:
+        if name not in _executors:
+            _executors[name] = ThreadPoolExecutor(max_workers=UPSTREAM_THREADS, thread_name_prefix=f"compass-{name}")
+        return _executors[name]
+
+
+def unavailable_reason(error):
+    if isinstance(error, CircuitOpen):
+        return 'circuit_open'
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return 'timeout'
+    return 'error'
+
+
+def call(name, func, cap, hedge_after=0):
+    # Blocking upstream call through name's circuit breaker, abandoned (DeadlineExceeded)
+    # once cap or the request budget runs out. func takes the timeout in seconds.
+    timeout = time_left(cap)
+    circuit = breaker(name)
+    circuit.allow()
+    try:
+        result = _hedged(name, func, timeout, hedge_after)
+    except Exception:
+        circuit.failure()
+        raise
+    except BaseException:
+        circuit.abandon()
+        raise
+    circuit.success()
+    return result
+
+
+def _hedged(name, func, timeout, hedge_after):
+    started = time.monotonic()
+    pool = executor(name)
+    attempts = {pool.submit(func, timeout): 'primary'}
+    if hedge_after and hedge_after < timeout:
+        done, _ = wait(attempts, hedge_after)
+        if not done:
+            attempts[pool.submit(func, timeout - hedge_after)] = 'hedge'
+    pending = set(attempts)
+    error = None
+    while pending:
+        done, pending = wait(pending, max(0.0, timeout - (time.monotonic() - started)), return_when=FIRST_COMPLETED)
+        if not done:
+            # The attempts keep their thread until their own timeout fires
+            raise DeadlineExceeded(f"{name} did not answer within {timeout:.1f}s")
+        for attempt in done:
+            if attempt.exception() is None:
+                if len(attempts) > 1:
+                    count_hedge(name, attempts[attempt])
+                return attempt.result()
+            error = attempt.exception()
+    raise error
+
+
+async def acall(name, func, cap, hedge_after=0):
+    # asyncio version of call; func is a coroutine function taking the timeout, and
+    # attempts that lose or run out of time are cancelled
+    timeout = time_left(cap)
+    circuit = breaker(name)
+    circuit.allow()
+    try:
+        result = await asyncio.wait_for(_ahedged(name, func, timeout, hedge_after), timeout)
+    except asyncio.TimeoutError:
+        circuit.failure()
+        raise DeadlineExceeded(f"{name} did not answer within {timeout:.1f}s")
+    except Exception:
+        circuit.failure()
+        raise
+    except BaseException:
+        # Cancelled by the caller
+        circuit.abandon()
+        raise
+    circuit.success()
+    return result
+
+
+async def _ahedged(name, func, timeout, hedge_after):
+    attempts = {asyncio.ensure_future(func(timeout)): 'primary'}
+    try:
+        if hedge_after and hedge_after < timeout:
+            done, _ = await asyncio.wait(attempts, timeout=hedge_after)
+            if not done:
+                attempts[asyncio.ensure_future(func(timeout - hedge_after))] = 'hedge'
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+            for attempt in done:
+                if attempt.exception() is None:
+                    if len(attempts) > 1:
+                        count_hedge(name, attempts[attempt])
+                    return attempt.result()
+                error = attempt.exception()
+        raise error
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+
+async def astream(name, stream, cap):
+    # Items of the async iterator stream through name's circuit breaker, failing with
+    # DeadlineExceeded once cap or the request budget runs out
+    deadline = time.monotonic() + time_left(cap)
+    circuit = breaker(name)
+    circuit.allow()
+    iterator = stream.__aiter__()
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(iterator.__anext__(), deadline - time.monotonic())
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(f"{name} did not finish within {cap:.1f}s")
+            yield item
+    except Exception:
+        circuit.failure()
+        raise
+    except BaseException:
+        # The consumer closed the stream or was cancelled
+        circuit.abandon()
+        raise
+    circuit.success()
+
+
+def optional(name, func):
+    # (func(), None) or, when it fails, (None, reason) so the caller can answer without it
+    try:
+        return func(), None
+    except Exception as e:
+        return None, _degrade(name, e)
+
+
+async def aoptional(name, func):
+    try:
+        return await func(), None
+    except Exception as e:
+        return None, _degrade(name, e)
+
+
+def _degrade(name, error):
+    reason = unavailable_reason(error)
+    count_degraded(name, reason)
+    logger.warning("Answering without %s (%s): %s", name, reason, error)
+    return reason
+
+
+def install_fastapi(app):
+    @app.middleware("http")
+    async def budget(request, call_next):
+        with request_budget():
+            return await call_next(request)
+
+
+def install_flask(app):
+    from flask import g
+
+    @app.before_request
+    def begin_budget():
+        g.budget_token = _deadline.set(time.monotonic() + REQUEST_BUDGET)
+
+    @app.teardown_request
+    def end_budget(error=None):
+        token = g.pop('budget_token', None)
+        if token is not None:
+            _deadline.reset(token)
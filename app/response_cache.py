@@ -0,0 +1,282 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from async_utils import run_blocking
+from metrics import count_cache
+
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")  # memory, sqlite or off
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "/tmp/response_cache.sqlite3")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+# Cosine distance under which a cached answer is reused for a different query; unset disables it
+RESPONSE_CACHE_SEMANTIC_DISTANCE = os.getenv("RESPONSE_CACHE_SEMANTIC_DISTANCE")
+
+
+def normalize_text(value):
+    return re.sub(r'\s+', ' ', str(value)).strip().lower()
+
+
+def prompt_key(prompt_inputs, catalog):
+    normalized = {name: normalize_text(value) for name, value in prompt_inputs.items()}
+    return hashlib.sha256(json.dumps([catalog, normalized], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def journey_bucket(catalog, journey):
+    # Entries are grouped per catalog, so catalogs sharing a journey name neither serve nor
+    # invalidate each other's answers. Catalog names cannot contain '/'.
+    return f"{catalog}/{journey}"
+
+
+class MemoryBackend:
+    # Safe to call from the event loop
+    blocking = False
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._by_journey = {}
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._by_journey.get(entry['journey'])
+            keys.discard(key)
+            if not keys:
+                del self._by_journey[entry['journey']]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, entry):
+        with self._lock:
+            self._remove(entry['key'])
+            self._entries[entry['key']] = entry
+            self._by_journey.setdefault(entry['journey'], set()).add(entry['key'])
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def for_journey(self, journey):
+        with self._lock:
+            return [self._entries[key] for key in self._by_journey.get(journey, ())]
+
+    def evict(self, max_entries):
+        with self._lock:
+            evicted = 0
+            while len(self._entries) > max_entries:
+                self._remove(next(iter(self._entries)))
+                evicted += 1
+            return evicted
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteBackend:
+    # Disk I/O: the async services call it through the executor
+    blocking = True
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        # key -> last read time, written with the next put or eviction instead of
+        # committing on every read
+        self._touched = {}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, journey TEXT, fingerprint TEXT, "
+            "embedding BLOB, response TEXT, created_at REAL, used_at REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_journey ON responses (journey)")
+        self._db.commit()
+
+    def _entry(self, row):
+        key, journey, fingerprint, embedding, response, created_at = row
+        return {
+            'key': key,
+            'journey': journey,
+            'fingerprint': fingerprint,
+            'embedding': np.frombuffer(embedding, dtype=np.float32) if embedding else None,
+            'response': response,
+            'created_at': created_at,
+        }
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT key, journey, fingerprint, embedding, response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._touched[key] = time.time()
+        return self._entry(row)
+
+    def _flush_touched(self):
+        if self._touched:
+            self._db.executemany("UPDATE responses SET used_at = ? WHERE key = ?",
+                                 [(used_at, key) for key, used_at in self._touched.items()])
+            self._touched = {}
+
+    def put(self, entry):
+        embedding = entry['embedding']
+        with self._lock:
+            self._flush_touched()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (entry['key'], entry['journey'], entry['fingerprint'],
+                 np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None else None,
+                 entry['response'], entry['created_at'], time.time()),
+            )
+            self._db.commit()
+
+    def delete(self, keys):
+        with self._lock:
+            self._db.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in keys])
+            self._db.commit()
+
+    def for_journey(self, journey):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, journey, fingerprint, embedding, response, created_at FROM responses WHERE journey = ?",
+                (journey,),
+            ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def evict(self, max_entries):
+        with self._lock:
+            self._flush_touched()
+            cursor = self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (max_entries,),
+            )
+            self._db.commit()
+            return cursor.rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class ResponseCache:
+    # Generated recipe text keyed on the catalog and the normalized prompt inputs. Entries
+    # remember the journey they answer and a fingerprint of its catalog rows, so a sheet
+    # change for that journey invalidates them. In semantic mode a query whose embedding is
+    # close enough to a cached query for the same journey of the same catalog reuses that
+    # answer. The backends store the journey bucket in their journey field.
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_SIZE, semantic_distance=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.semantic_distance = semantic_distance
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _valid(self, entry, fingerprint):
+        if time.time() - entry['created_at'] > self.ttl:
+            self.evictions += 1
+            self.backend.delete([entry['key']])
+            return False
+        if entry['fingerprint'] != fingerprint:
+            self.invalidations += 1
+            self.backend.delete([entry['key']])
+            return False
+        return True
+
+    def _nearest(self, journey, fingerprint, embedding):
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        best, best_distance = None, None
+        for entry in self.backend.for_journey(journey):
+            if entry['embedding'] is None or not self._valid(entry, fingerprint):
+                continue
+            cached = np.asarray(entry['embedding'], dtype=np.float32)
+            distance = 1 - float(np.dot(query, cached / (np.linalg.norm(cached) or 1)))
+            if distance <= self.semantic_distance and (best_distance is None or distance < best_distance):
+                best, best_distance = entry, distance
+        return best
+
+    def lookup(self, prompt_inputs, catalog, journey, fingerprint, embedding=None):
+        # Returns (response, status) where status is "hit", "semantic" or "miss"
+        response, status = self._lookup(prompt_inputs, catalog, journey, fingerprint, embedding)
+        count_cache("response", status)
+        return response, status
+
+    def _lookup(self, prompt_inputs, catalog, journey, fingerprint, embedding):
+        entry = self.backend.get(prompt_key(prompt_inputs, catalog))
+        if entry is not None and self._valid(entry, fingerprint):
+            self.hits += 1
+            return entry['response'], "hit"
+        if self.semantic_distance is not None and embedding is not None:
+            entry = self._nearest(journey_bucket(catalog, journey), fingerprint, embedding)
+            if entry is not None:
+                self.semantic_hits += 1
+                return entry['response'], "semantic"
+        self.misses += 1
+        return None, "miss"
+
+    async def alookup(self, prompt_inputs, catalog, journey, fingerprint, embedding=None):
+        # lookup for the event loop; SQLite reads run in the executor
+        if self.backend.blocking:
+            return await run_blocking(self.lookup, prompt_inputs, catalog, journey, fingerprint, embedding)
+        return self.lookup(prompt_inputs, catalog, journey, fingerprint, embedding)
+
+    async def astore(self, prompt_inputs, catalog, journey, fingerprint, response, embedding=None):
+        if self.backend.blocking:
+            return await run_blocking(self.store, prompt_inputs, catalog, journey, fingerprint, response, embedding)
+        return self.store(prompt_inputs, catalog, journey, fingerprint, response, embedding)
+
+    def store(self, prompt_inputs, catalog, journey, fingerprint, response, embedding=None):
+        self.backend.put({
+            'key': prompt_key(prompt_inputs, catalog),
+            'journey': journey_bucket(catalog, journey),
+            'fingerprint': fingerprint,
+            'embedding': embedding,
+            'response': response,
+            'created_at': time.time(),
+        })
+        self.evictions += self.backend.evict(self.max_entries)
+
+    def invalidate_journey(self, catalog, journey):
+        keys = [entry['key'] for entry in self.backend.for_journey(journey_bucket(catalog, journey))]
+        self.backend.delete(keys)
+        self.invalidations += len(keys)
+
+    def stats(self):
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self.backend),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.semantic_hits) / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+def response_cache_from_env():
+    if RESPONSE_CACHE_BACKEND == 'off':
+        return None
+    if RESPONSE_CACHE_BACKEND == 'sqlite':
+        backend = SqliteBackend(RESPONSE_CACHE_PATH)
+    else:
+        backend = MemoryBackend()
+    semantic_distance = float(RESPONSE_CACHE_SEMANTIC_DISTANCE) if RESPONSE_CACHE_SEMANTIC_DISTANCE else None
+    return ResponseCache(backend, semantic_distance=semantic_distance)
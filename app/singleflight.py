@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import os
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking on platforms without flock
+    fcntl = None
+
+from async_utils import run_blocking
+from metrics import count_singleflight
+
+# Also serialize cross-process flights (index builds, LLM prompts) between the worker
+# processes of one host with per-key lock files. This only saves duplicate work; index
+# builds are safe across workers without it.
+SINGLEFLIGHT_FILE_LOCK = os.getenv("SINGLEFLIGHT_FILE_LOCK", "0") == "1" and fcntl is not None
+SINGLEFLIGHT_LOCK_DIR = os.getenv("SINGLEFLIGHT_LOCK_DIR", "/tmp/compass-locks")
+
+
+def _lock_file(name, key):
+    os.makedirs(SINGLEFLIGHT_LOCK_DIR, exist_ok=True)
+    digest = hashlib.sha256(f"{name}\0{key}".encode('utf-8')).hexdigest()[:32]
+    return open(os.path.join(SINGLEFLIGHT_LOCK_DIR, f"{name}-{digest}.lock"), 'a')
+
+
+@contextmanager
+def process_lock(name, key):
+    # Exclusive flock for (name, key); a no-op unless SINGLEFLIGHT_FILE_LOCK=1
+    if not SINGLEFLIGHT_FILE_LOCK:
+        yield
+        return
+    with _lock_file(name, key) as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@asynccontextmanager
+async def async_process_lock(name, key):
+    # Same as process_lock, waiting for the lock in the executor instead of the event loop
+    if not SINGLEFLIGHT_FILE_LOCK:
+        yield
+        return
+    with _lock_file(name, key) as f:
+        await run_blocking(fcntl.flock, f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # At most one computation per key is in flight in this process; callers arriving
+    # while it runs wait for it and share its result or exception. With cross_process the
+    # computation also holds a per-key file lock, and recheck (typically a lookup in a
+    # cache the other processes write to) runs once the lock is held, before computing.
+
+    def __init__(self, name, cross_process=False):
+        self.name = name
+        self.cross_process = cross_process
+        self._tasks = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    async def run(self, key, func, recheck=None):
+        # func and recheck are coroutine functions without arguments
+        task = self._tasks.get(key)
+        if task is None:
+            count_singleflight(self.name, "leader")
+            task = asyncio.ensure_future(self._lead(key, func, recheck))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._tasks.pop(key) if self._tasks.get(key) is done else None)
+        else:
+            count_singleflight(self.name, "shared")
+        # Shielded, so a caller that disconnects does not cancel the others' computation
+        return await asyncio.shield(task)
+
+    async def _lead(self, key, func, recheck):
+        if not self.cross_process:
+            return await func()
+        async with async_process_lock(self.name, key):
+            if recheck is not None and SINGLEFLIGHT_FILE_LOCK:
+                result = await recheck()
+                if result is not None:
+                    return result
+            return await func()
+
+    def run_sync(self, key, func, recheck=None):
+        # Thread-based equivalent of run for the Flask services
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            count_singleflight(self.name, "shared")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        count_singleflight(self.name, "leader")
+        try:
+            call.result = self._lead_sync(key, func, recheck)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _lead_sync(self, key, func, recheck):
+        if not self.cross_process:
+            return func()
+        with process_lock(self.name, key):
+            if recheck is not None and SINGLEFLIGHT_FILE_LOCK:
+                result = recheck()
+                if result is not None:
+                    return result
+            return func()
@@ -0,0 +1,169 @@
+import asyncio
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import record_startup
+
+logger = logging.getLogger(__name__)
+
+# eager: warm the catalog and index before the port accepts traffic
+# background: accept traffic immediately and warm in the background
+# off: nothing is warmed; the first request pays for it
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "eager")
+# A failed warm-up is retried in the background after this many seconds, doubling up to
+# STARTUP_RETRY_MAX, so a sheet outage at boot does not keep /ready at 503 for good
+STARTUP_RETRY_INITIAL = float(os.getenv("STARTUP_RETRY_INITIAL", "1"))
+STARTUP_RETRY_MAX = float(os.getenv("STARTUP_RETRY_MAX", "60"))
+
+
+class StartupReport:
+    # Where a process spent its time between being imported and being ready to serve.
+    # The clock starts when this module is first imported, which the services do first.
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.status = 'cold'
+        self.error = None
+        self.ready_after = None
+        self.attempts = 0
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(self.phases.get(name, 0) + time.perf_counter() - started, 4)
+
+    def mark_imported(self):
+        self.phases.setdefault('import', round(time.perf_counter() - self.started, 4))
+
+    def begin(self):
+        self.status = 'warming'
+        self.attempts += 1
+
+    def retry_delay(self):
+        return min(STARTUP_RETRY_MAX, STARTUP_RETRY_INITIAL * 2 ** (self.attempts - 1))
+
+    def finish(self, error=None):
+        self.status = 'failed' if error else 'ready'
+        self.error = str(error) if error else None
+        self.ready_after = round(time.perf_counter() - self.started, 4)
+        record_startup(dict(self.phases, total=self.ready_after))
+        breakdown = ', '.join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.phases.items())
+        if error:
+            logger.warning("Warm-up attempt %d failed after %.0fms (%s), retrying in %.1fs: %s", self.attempts,
+                           self.ready_after * 1000, breakdown, self.retry_delay(), error)
+        else:
+            logger.info("Ready after %.0fms: %s", self.ready_after * 1000, breakdown)
+
+    def as_dict(self):
+        return {
+            "ready": self.status == 'ready',
+            "status": self.status,
+            "warmup": STARTUP_WARMUP,
+            "ready_after": self.ready_after,
+            "attempts": self.attempts,
+            "phases": self.phases,
+            "error": self.error,
+        }
+
+
+report = StartupReport()
+phase = report.phase
+
+
+def preload(*modules):
+    # Imports deferred modules ahead of the first request, timing each one
+    for name in modules:
+        if name not in sys.modules:
+            with report.phase(f"import:{name}"):
+                importlib.import_module(name)
+
+
+def install_fastapi(app, warm_up):
+    # warm_up is a coroutine function. In eager mode it runs in the startup event, which
+    # uvicorn finishes before it starts accepting connections.
+    from fastapi.responses import JSONResponse
+
+    async def attempt():
+        report.begin()
+        try:
+            await warm_up()
+        except Exception as e:
+            report.finish(e)
+            return False
+        report.finish()
+        return True
+
+    async def retry():
+        # Requests meanwhile load the catalog and index lazily
+        while True:
+            await asyncio.sleep(report.retry_delay())
+            if await attempt():
+                return
+
+    async def run():
+        if not await attempt():
+            await retry()
+
+    @app.on_event("startup")
+    async def warm():
+        report.mark_imported()
+        if STARTUP_WARMUP == 'eager':
+            # Only the first attempt holds up serving
+            if not await attempt():
+                app.state.warm_up_task = asyncio.create_task(retry())
+        elif STARTUP_WARMUP == 'background':
+            app.state.warm_up_task = asyncio.create_task(run())
+        else:
+            report.finish()
+
+    @app.get("/ready")
+    async def ready():
+        return JSONResponse(report.as_dict(), status_code=200 if report.status == 'ready' else 503)
+
+
+def install_flask(app, warm_up):
+    # Flask has no startup event, so eager warm-up runs while the module is imported,
+    # before `flask run`, gunicorn or app.run() can route a request to it
+    from flask import jsonify
+
+    def attempt():
+        report.begin()
+        try:
+            warm_up()
+        except Exception as e:
+            report.finish(e)
+            return False
+        report.finish()
+        return True
+
+    def retry():
+        while True:
+            time.sleep(report.retry_delay())
+            if attempt():
+                return
+
+    def run():
+        if not attempt():
+            retry()
+
+    report.mark_imported()
+    if STARTUP_WARMUP == 'eager':
+        if not attempt():
+            threading.Thread(target=retry, name="compass-warmup", daemon=True).start()
+    elif STARTUP_WARMUP == 'background':
+        threading.Thread(target=run, name="compass-warmup", daemon=True).start()
+    else:
+        report.finish()
+
+    @app.route('/ready')
+    def ready():
+        return jsonify(report.as_dict()), 200 if report.status == 'ready' else 503
@@ -0,0 +1,44 @@
+import asyncio
+import os
+import time
+
+from langchain.chat_models.base import SimpleChatModel
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+from langchain.schema.messages import AIMessageChunk
+from langchain.schema.output import ChatGenerationChunk
+
+# Seconds the stub LLM waits before answering (time to first token when streaming)
+STUB_LLM_LATENCY = float(os.getenv("STUB_LLM_LATENCY", "0"))
+# Seconds between streamed stub tokens
+STUB_LLM_TOKEN_LATENCY = float(os.getenv("STUB_LLM_TOKEN_LATENCY", "0"))
+
+
+class StubChatModel(SimpleChatModel):
+    # Offline stand-in for ChatOpenAI with configurable latency. It answers with a fixed
+    # sentence built from the prompt, so responses are deterministic.
+
+    latency: float = STUB_LLM_LATENCY
+    token_latency: float = STUB_LLM_TOKEN_LATENCY
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def _reply(self, messages):
+        prompt = messages[-1].content if messages else ''
+        return f"Stub response for: {prompt}"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return self._reply(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        for i, word in enumerate(self._reply(messages).split(' ')):
+            if i and self.token_latency:
+                await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else f" {word}"))
@@ -1,55 +1,54 @@
+import startup
 from flask import Flask, request, jsonify
 from flask_cors import CORS  # Added for CORS support
 import json
-import requests
 from dotenv import load_dotenv
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from langchain.vectorstores import Chroma
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.schema import Document
+from catalog import Catalog, PUBLISHED_SHEET_URL
 import os
 import numpy as np
+from backends import get_chat_model, get_embeddings
+from embedding_cache import CachedEmbeddings
+from response_cache import prompt_key, response_cache_from_env
+from singleflight import SingleFlight
+from bundle import load_bundle, seed_from_bundle
+from lexical import CONFIDENT_PATHS, LEXICAL_MATCH, LexicalMatcher
+from vector_stores import journey_index_from_env
+import metrics
+import resilience
+import catalog_registry
+from metrics import count_match_path, stage, upstream
+from resilience import LLM_TIMEOUT, call, optional
+from prompt_builder import build_prompt, get_encoding
+from catalog_registry import DEFAULT_CATALOG, CatalogEntry, CatalogRegistry
 
 app = Flask(__name__)
 CORS(app)  # Initialize CORS on the Flask app
+metrics.install_flask(app, 'test_use_embeddings')
+resilience.install_flask(app)
 load_dotenv()
 
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
-def load_data_from_url(url):
-    response = requests.get(url)
-    response.raise_for_status()
-    return response.json()
-
-def get_agenda_items(recipe_name, data):
-    agenda_items = []
-    for entry in data:
-        if entry['Journey Name (N)'] == recipe_name:
-            agenda_items.append(entry['Agenda Items (Description)'])
-    return agenda_items if agenda_items else None
-
-def get_methods(recipe_name, data):
-    methods = []
-    for entry in data:
-        if entry['Journey Name (N)'] == recipe_name:
-            methods.append(entry['Methods (N)'])
-    return methods if methods else None
-
-def get_method_details(methods_list, data):
-    method_details = []
-    for method in methods_list:
-        method = method.strip()  # Remove any leading/trailing whitespace
-        for entry in data:
-            if entry.get('Uniques') == method:
-                method_details.append({
-                    'method': method,
-                    'description_short': entry.get('Description (short)', ''),
-                    'ai_response': entry.get('AI Response', '')
-                })
-                break  # Stop searching after the first match
-    return method_details
+catalog = Catalog(PUBLISHED_SHEET_URL, PUBLISHED_SHEET_URL)
+embeddings = CachedEmbeddings(get_embeddings(openai_api_key))
+response_cache = response_cache_from_env()
+# Identical prompts arriving together share one LLM call
+llm_flight = SingleFlight("llm", cross_process=True)
+# Catalog from a prebuilt bundle (`python bundle.py --source published`), if present
+with startup.phase("bundle"):
+    bundle = load_bundle('published', embeddings, PUBLISHED_SHEET_URL, PUBLISHED_SHEET_URL)
+lexical_matcher = LexicalMatcher()
+# Journey vectors, rebuilt from the embedding cache when the catalog changes
+# (chroma unless VECTOR_STORE selects another store)
+FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", 'faiss_index.bin')
+journey_vectors = journey_index_from_env(FAISS_INDEX_PATH, embeddings, default='chroma')
+seed_from_bundle(bundle, catalog, journey_vectors)
+# The workbook above is the default catalog; CATALOGS adds client catalogs, each with its
+# own sheets, tables and vectors, loaded on first use
+registry = CatalogRegistry(CatalogEntry(DEFAULT_CATALOG, catalog, journey_vectors, lexical_matcher),
+                           embeddings, FAISS_INDEX_PATH, index_default='chroma')
+catalog_registry.install_flask(app, registry)
+
 
 @app.route('/get_recipe', methods=['POST'])
 def get_recipe():
@@ -57,51 +56,82 @@ def get_recipe():
     recipe_name = content.get('recipe_name')
     if not recipe_name:
         return jsonify({"error": "No recipe name provided"}), 400
+    entry = registry.resolve(content, request.headers)
+
+    # langchain is imported on first use; warm-up normally has it loaded already
+    from langchain.chains import LLMChain
+    from langchain.prompts import PromptTemplate
 
-    tasks_url = 'https://gs.jasonaa.me/?url=https://docs.google.com/spreadsheets/d/e/2PACX-1vSmp889ksBKKVVwpaxhlIzpDzXNOWjnszEXBP7SC5AyoebSIBFuX5qrcwwv6ud4RCYw2t_BZRhGLT0u/pubhtml?gid=1980586524&single=true'
-    flow_url = 'https://gs.jasonaa.me/?url=https://docs.google.com/spreadsheets/d/e/2PACX-1vSmp889ksBKKVVwpaxhlIzpDzXNOWjnszEXBP7SC5AyoebSIBFuX5qrcwwv6ud4RCYw2t_BZRhGLT0u/pubhtml?gid=1980586524&single=true'
-    tasks_data = load_data_from_url(tasks_url)
-    flow_data = load_data_from_url(flow_url)
+    # Tasks and flow both live in the published workbook held by the catalog
+    snapshot = entry.catalog.get()
 
     # Initialize the language model
-    llm = ChatOpenAI(model="gpt-4", temperature=.2, openai_api_key=openai_api_key)
-    
-    # Load or create vectorstore
+    llm = get_chat_model(openai_api_key)
     
-    # Load or create vectorstore
-    vectorstore_path = './chroma_db'
-    embedding_function = OpenAIEmbeddings(api_key=openai_api_key)
-    if os.path.exists(vectorstore_path) and os.listdir(vectorstore_path):
-        vectorstore = Chroma(persist_directory=vectorstore_path, embedding_function=embedding_function)
+    # Recipe names typed (almost) verbatim are matched locally, without embedding the
+    # query. Anything less certain goes to the vector store.
+    path, lexical_matches, query_vector = 'vector', [], None
+    if LEXICAL_MATCH:
+        with stage("lexical_search"):
+            path, lexical_matches = entry.lexical.get(snapshot).classify(recipe_name)
+    if path in CONFIDENT_PATHS:
+        similar_docs = lexical_matches
     else:
-        # Convert the tasks to Document objects
-        documents = [Document(page_content=task['Journey Name (N)']) for task in tasks_data]
-        # Create an embeddings model
-        embeddings = OpenAIEmbeddings(api_key=openai_api_key)
-        # Create a Chroma vectorstore from the documents
-    
-        # Save the vectorstore for future use
-        # Save the vectorstore to disk with persistence
-        vectorstore = Chroma.from_documents(documents, embeddings, persist_directory="./chroma_db")
-        # vectorstore.save(vectorstore_path)
+        path = 'vector'
+        # Built from the cached journey vectors whenever the catalog changes, so it never
+        # serves journeys that were removed from the sheet
+        store = registry.index(entry, snapshot)
+        query_vector = embeddings.embed_query(recipe_name)
 
-    # Perform a similarity search
-    similar_docs = vectorstore.similarity_search(recipe_name, k=1)
+        # Perform a similarity search
+        with stage("vector_search"):
+            similar_docs = store.search(query_vector, 1)
+    count_match_path(path)
     if similar_docs:
-        closest_task = similar_docs[0].page_content
-        similarity = np.linalg.norm(np.array(vectorstore.embeddings.embed_query(recipe_name)) - np.array(vectorstore.embeddings.embed_query(closest_task)))
+        closest_task = similar_docs[0][0]
+        if path in CONFIDENT_PATHS:
+            # Same distance scale as below, with the lexical confidence standing in for cosine
+            similarity = float(np.sqrt(max(0.0, 2 - 2 * lexical_matches[0][1])))
+        else:
+            similarity = np.linalg.norm(np.array(query_vector) - np.array(embeddings.embed_query(closest_task)))
         
         # Get agenda items and methods for the closest task
-        agenda_items = get_agenda_items(closest_task, flow_data)
-        methods_str = get_methods(closest_task, flow_data)  # New line to get methods
-        method_details = get_method_details(methods_str, tasks_data)  # Get method details
+        with stage("catalog_lookup"):
+            agenda_items = snapshot.get_agenda_items(closest_task)
+            methods = snapshot.get_methods(closest_task)
+            method_details = snapshot.get_method_details(methods)
         
         if agenda_items and method_details:
             # Create a chain that uses the language model to generate a complete sentence
             template = "Based on your input, I suggest you to follow these steps: {agenda_items}. This suggestion is based on the recipe '{recipe_name}', which is {similarity}% similar to your input. The original recipe that it is matching with is '{closest_task}'."
             prompt = PromptTemplate(template=template, input_variables=["agenda_items", "recipe_name", "similarity", "closest_task"])
             llm_chain = LLMChain(prompt=prompt, llm=llm)
-            response = llm_chain.run({"agenda_items": ', '.join(agenda_items), "recipe_name": recipe_name, "similarity": round(similarity * 100, 2), "closest_task": closest_task})
+            # Agenda items beyond PROMPT_TOKEN_BUDGET are dropped, least relevant to the recipe first
+            plan = build_prompt(template, agenda_items, {"recipe_name": recipe_name, "similarity": round(similarity * 100, 2), "closest_task": closest_task}, recipe_name)
+            prompt_inputs = plan.inputs
+            fingerprint = snapshot.journey_fingerprint(closest_task)
+            response, cache_status, degraded = None, "off", {}
+            if response_cache is not None:
+                response, cache_status = response_cache.lookup(prompt_inputs, entry.name, closest_task, fingerprint, query_vector)
+            if response is None:
+                def generate():
+                    with upstream("llm"):
+                        generated = call("llm", lambda timeout: llm_chain.run(prompt_inputs), LLM_TIMEOUT)
+                    plan.record(generated)
+                    if response_cache is not None:
+                        response_cache.store(prompt_inputs, entry.name, closest_task, fingerprint, generated, query_vector)
+                    return generated
+
+                def recheck():
+                    if response_cache is not None:
+                        return response_cache.lookup(prompt_inputs, entry.name, closest_task, fingerprint, query_vector)[0]
+
+                # Over budget, failing or behind an open circuit, the LLM is skipped and the
+                # match is returned with the text marked unavailable
+                response, reason = optional("llm", lambda: llm_flight.run_sync(
+                    f"{prompt_key(prompt_inputs, entry.name)}:{fingerprint}", generate, recheck))
+                if reason is not None:
+                    degraded["llm"] = reason
             return jsonify({
                 "response": response,
                 "details": {
@@ -109,13 +139,41 @@ def get_recipe():
                     "Methods": '| '.join([detail['method'] for detail in method_details]),
                     "Method Details": method_details,
                     "Similarity": f"{similarity}% similar to that task"
-                }
+                },
+                "match_path": path,
+                "catalog": entry.name,
+                "catalog_age": snapshot.age(),
+                "bundle_version": snapshot.bundle_version,
+                "response_cache": cache_status,
+                "degraded": degraded,
+                "usage": plan.usage(response)
             })
         else:
             return jsonify({"error": "Agenda Items or Methods not found for the task"}), 404
     else:
         return jsonify({"error": "Task not found"}), 404
 
+@app.route('/refresh_catalog', methods=['POST'])
+def refresh_catalog():
+    entry = registry.resolve(request.args, request.headers)
+    try:
+        snapshot = entry.catalog.refresh()
+    except Exception as e:
+        return jsonify({"error": f"Catalog refresh failed: {e}"}), 502
+    return jsonify({"refreshed": True, "catalog": entry.name, "catalog_age": snapshot.age()})
+
+def warm_up():
+    with startup.phase("catalog"):
+        snapshot = catalog.get()
+    startup.preload('langchain.chains', 'langchain.prompts')
+    with startup.phase("tokenizer"):
+        get_encoding()
+    # Journey names are embedded (or read from the cache) and indexed before the first request
+    with startup.phase("index"):
+        registry.index(registry.default, snapshot)
+
+startup.install_flask(app, warm_up)
+
 if __name__ == "__main__":
     app.run(debug=True)
 
@@ -1,18 +1,32 @@
+import startup
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 import json
-import requests
+import functools
+import time
 from dotenv import load_dotenv
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from langchain.vectorstores import FAISS
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.schema import Document
+from catalog import Catalog, PUBLISHED_SHEET_URL
 import os
 import numpy as np
 import os.path
+from backends import get_chat_model, get_embeddings
+from embedding_cache import CachedEmbeddings
+from vector_stores import journey_index_from_env
+from lexical import CONFIDENT_PATHS, FUSION_CANDIDATES, LEXICAL_MATCH, LexicalMatcher, fuse_scores
+from async_utils import close_http_client, run_blocking
+import metrics
+import resilience
+import methods_api
+import catalog_registry
+from metrics import count_degraded, count_match_path, count_upstream_error, record_stage, stage, upstream
+from response_cache import prompt_key, response_cache_from_env
+from singleflight import SingleFlight
+from resilience import LLM_TIMEOUT, acall, aoptional, astream, time_left, unavailable_reason
+from bundle import load_bundle, seed_from_bundle
+from catalog_registry import DEFAULT_CATALOG, CatalogEntry, CatalogRegistry
+from prompt_builder import build_prompt, get_encoding
 
 app = FastAPI()
 app.add_middleware(
@@ -23,53 +37,99 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+metrics.install_fastapi(app, 'test_w_FAISS')
+resilience.install_fastapi(app)
 load_dotenv()
 
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
-FAISS_INDEX_FILE = 'faiss_index.bin'
-
-def save_faiss_index(db):
-    db.save_local(FAISS_INDEX_FILE)
-
-def load_faiss_index_if_exists(embeddings):
-    if os.path.exists(FAISS_INDEX_FILE):
-        return FAISS.load_local(FAISS_INDEX_FILE, embeddings)
-    return None
-
-def load_data_from_url(url):
-    response = requests.get(url)
-    response.raise_for_status()
-    return response.json()
-
-def get_agenda_items(recipe_name, data):
-    agenda_items = []
-    for entry in data:
-        if entry['Journey Name (N)'] == recipe_name:
-            agenda_items.append(entry['Agenda Items (Description)'])
-    return agenda_items if agenda_items else None
-
-def get_methods(recipe_name, data):
-    methods = []
-    for entry in data:
-        if entry['Journey Name (N)'] == recipe_name:
-            methods.append(entry['Methods (N)'])
-    return methods if methods else None
-
-def get_method_details(methods_list, data):
-    method_details = []
-    for method in methods_list:
-        method = method.strip()  # Remove any leading/trailing whitespace
-        for entry in data:
-            if entry.get('Uniques') == method:
-                method_details.append({
-                    'method': method,
-                    'description_short': entry.get('Description (short)', ''),
-                    'ai_response': entry.get('AI Response', '')
-                })
-                break  # Stop searching after the first match
-    return method_details
+FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", 'faiss_index.bin')
 
+catalog = Catalog(PUBLISHED_SHEET_URL, PUBLISHED_SHEET_URL)
+embeddings = CachedEmbeddings(get_embeddings(openai_api_key))
+# Persisted FAISS journey index unless VECTOR_STORE selects another store
+journey_index = journey_index_from_env(FAISS_INDEX_PATH, embeddings)
+# Prebuilt catalog and index from `python bundle.py --source published`, if present
+with startup.phase("bundle"):
+    bundle = load_bundle('published', embeddings, PUBLISHED_SHEET_URL, PUBLISHED_SHEET_URL)
+seed_from_bundle(bundle, catalog, journey_index)
+lexical_matcher = LexicalMatcher()
+# The workbook above is the default catalog; CATALOGS adds client catalogs, each with its
+# own sheets, tables and index, loaded on first use
+registry = CatalogRegistry(CatalogEntry(DEFAULT_CATALOG, catalog, journey_index, lexical_matcher),
+                           embeddings, FAISS_INDEX_PATH)
+
+
+TEMPLATE = "Based on your input, I suggest you to follow these steps: {agenda_items}. This suggestion is based on the recipe '{recipe_name}', which is {similarity}% similar to your input. The original recipe that it is matching with is '{closest_task}'."
+# Generated text for previously answered prompts; None when RESPONSE_CACHE_BACKEND=off
+response_cache = response_cache_from_env()
+# Identical prompts arriving together share one LLM call
+llm_flight = SingleFlight("llm", cross_process=True)
+
+
+@functools.lru_cache(maxsize=None)
+def get_llm_chain():
+    # langchain's chain modules are imported here, during warm-up or on first use
+    from langchain.chains import LLMChain
+    from langchain.prompts import PromptTemplate
+    prompt = PromptTemplate(template=TEMPLATE, input_variables=["agenda_items", "recipe_name", "similarity", "closest_task"])
+    # Shared language model so its HTTP connections are reused across requests
+    return LLMChain(prompt=prompt, llm=get_chat_model(openai_api_key))
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def match_recipe(recipe_name, entry):
+    # Deterministic part of get_recipe: closest task, methods and method details
+    # Tasks and flow both live in the published workbook held by the catalog
+    snapshot = await entry.catalog.aget()
+
+    # Recipe names typed (almost) verbatim are matched locally, without an embedding call
+    path, lexical_matches = 'vector', []
+    if LEXICAL_MATCH:
+        lexical_index = await entry.lexical.aget(snapshot)
+        with stage("lexical_search"):
+            path, lexical_matches = lexical_index.classify(recipe_name)
+    query_vector = None
+    if path in CONFIDENT_PATHS:
+        similar_docs = lexical_matches
+    else:
+        # Load the FAISS index, embedding only journeys added or changed since it was saved
+        db = await registry.aindex(entry, snapshot)
+
+        # Perform a similarity search
+        query_vector = await embeddings.aembed_query(recipe_name)
+        with stage("faiss_search"):
+            similar_docs = await run_blocking(db.search, query_vector, FUSION_CANDIDATES if path == 'fused' else 1)
+        if path == 'fused':
+            similar_docs = fuse_scores(lexical_matches, similar_docs)
+    count_match_path(path)
+    if not similar_docs:
+        raise HTTPException(status_code=404, detail="Task not found")
+    closest_task, score = similar_docs[0]
+    if query_vector is None:
+        # Same distance scale as below, with the lexical confidence standing in for cosine
+        similarity = float(np.sqrt(max(0.0, 2 - 2 * score)))
+    else:
+        similarity = np.linalg.norm(np.array(query_vector) - np.array(await embeddings.aembed_query(closest_task)))
+
+    # Get agenda items and methods for the closest task
+    with stage("catalog_lookup"):
+        agenda_items = snapshot.get_agenda_items(closest_task)
+        methods = snapshot.get_methods(closest_task)
+        method_details = snapshot.get_method_details(methods)
+    if not (agenda_items and method_details):
+        raise HTTPException(status_code=404, detail="Agenda Items or Methods not found for the task")
+
+    # Agenda items beyond PROMPT_TOKEN_BUDGET are dropped, least relevant to the recipe first
+    plan = build_prompt(TEMPLATE, agenda_items, {"recipe_name": recipe_name, "similarity": round(similarity * 100, 2), "closest_task": closest_task}, recipe_name)
+    details = {
+        "Closest Luma Task": closest_task,
+        "Methods": '| '.join([detail['method'] for detail in method_details]),
+        "Method Details": method_details,
+        "Similarity": f"{similarity}% similar to that task"
+    }
+    return snapshot, plan, details, query_vector, path
 
 @app.post('/get_recipe')
 async def get_recipe(request: Request):
@@ -78,55 +138,153 @@ async def get_recipe(request: Request):
     if not recipe_name:
         raise HTTPException(status_code=400, detail="No recipe name provided")
 
-    tasks_url = 'https://gs.jasonaa.me/?url=https://docs.google.com/spreadsheets/d/e/2PACX-1vSmp889ksBKKVVwpaxhlIzpDzXNOWjnszEXBP7SC5AyoebSIBFuX5qrcwwv6ud4RCYw2t_BZRhGLT0u/pubhtml?gid=1980586524&single=true'
-    flow_url = 'https://gs.jasonaa.me/?url=https://docs.google.com/spreadsheets/d/e/2PACX-1vSmp889ksBKKVVwpaxhlIzpDzXNOWjnszEXBP7SC5AyoebSIBFuX5qrcwwv6ud4RCYw2t_BZRhGLT0u/pubhtml?gid=1980586524&single=true'
-    tasks_data = load_data_from_url(tasks_url)
-    flow_data = load_data_from_url(flow_url)
-
-    # Initialize the language model
-    llm = ChatOpenAI(model="gpt-4", temperature=.2, openai_api_key=openai_api_key)
-    
-    # Create an embeddings model
-    embeddings = OpenAIEmbeddings(api_key=openai_api_key)
-
-    # Replace the FAISS index creation with a check to load if it exists
-    # If it doesn't exist, create it and save
-    db = load_faiss_index_if_exists(embeddings)
-    if db is None:
-        documents = [Document(page_content=task['Journey Name (N)']) for task in tasks_data]
-        db = FAISS.from_documents(documents, embeddings)
-        save_faiss_index(db)
-
-    # Perform a similarity search
-    similar_docs = db.similarity_search(recipe_name, k=1)
-    if similar_docs:
-        closest_task = similar_docs[0].page_content
-        similarity = np.linalg.norm(np.array(embeddings.embed_query(recipe_name)) - np.array(embeddings.embed_query(closest_task)))
-        
-        # Get agenda items and methods for the closest task
-        agenda_items = get_agenda_items(closest_task, flow_data)
-        methods_str = get_methods(closest_task, flow_data)  # New line to get methods
-        method_details = get_method_details(methods_str, tasks_data)  # Get method details
-        
-        if agenda_items and method_details:
-            # Create a chain that uses the language model to generate a complete sentence
-            template = "Based on your input, I suggest you to follow these steps: {agenda_items}. This suggestion is based on the recipe '{recipe_name}', which is {similarity}% similar to your input. The original recipe that it is matching with is '{closest_task}'."
-            prompt = PromptTemplate(template=template, input_variables=["agenda_items", "recipe_name", "similarity", "closest_task"])
-            llm_chain = LLMChain(prompt=prompt, llm=llm)
-            response = await llm_chain.run({"agenda_items": ', '.join(agenda_items), "recipe_name": recipe_name, "similarity": round(similarity * 100, 2), "closest_task": closest_task})
-            return JSONResponse({
-                "response": response,
-                "details": {
-                    "Closest Luma Task": closest_task,
-                    "Methods": '| '.join([detail['method'] for detail in method_details]),
-                    "Method Details": method_details,
-                    "Similarity": f"{similarity}% similar to that task"
-                }
-            })
-        else:
-            raise HTTPException(status_code=404, detail="Agenda Items or Methods not found for the task")
+    entry = registry.resolve(content, request.headers)
+    snapshot, plan, details, query_vector, path = await match_recipe(recipe_name, entry)
+    prompt_inputs = plan.inputs
+    closest_task = prompt_inputs["closest_task"]
+    fingerprint = snapshot.journey_fingerprint(closest_task)
+    response, cache_status, degraded = None, "off", {}
+    if response_cache is not None:
+        response, cache_status = await response_cache.alookup(prompt_inputs, entry.name, closest_task, fingerprint, query_vector)
+    if response is None:
+        # Use the language model to generate a complete sentence
+        async def generate():
+            with upstream("llm"):
+                generated = await acall("llm", lambda timeout: get_llm_chain().arun(prompt_inputs), LLM_TIMEOUT)
+            plan.record(generated)
+            if response_cache is not None:
+                await response_cache.astore(prompt_inputs, entry.name, closest_task, fingerprint, generated, query_vector)
+            return generated
+
+        async def recheck():
+            # Another worker may have answered the prompt while this one waited for the lock
+            if response_cache is not None:
+                return (await response_cache.alookup(prompt_inputs, entry.name, closest_task, fingerprint, query_vector))[0]
+
+        # A slow or failing LLM does not fail the request: the match is returned with the
+        # text marked unavailable. A shared generation that outlives this request still
+        # fills the response cache.
+        key = f"{prompt_key(prompt_inputs, entry.name)}:{fingerprint}"
+        response, reason = await aoptional("llm", lambda: asyncio.wait_for(
+            llm_flight.run(key, generate, recheck), time_left(LLM_TIMEOUT)))
+        if reason is not None:
+            degraded["llm"] = reason
+    return JSONResponse({
+        "response": response,
+        "details": details,
+        "match_path": path,
+        "catalog": entry.name,
+        "catalog_age": snapshot.age(),
+        "bundle_version": snapshot.bundle_version,
+        "response_cache": cache_status,
+        "degraded": degraded,
+        "usage": plan.usage(response)
+    })
+
+@app.api_route('/get_recipe/stream', methods=['GET', 'POST'])
+async def get_recipe_stream(request: Request):
+    # Server-Sent Events: a "match" event with the details as soon as matching is done,
+    # then one "token" event per LLM chunk and a final "done" event with timing and usage
+    if request.method == 'POST':
+        content = await request.json()
     else:
-        raise HTTPException(status_code=404, detail="Task not found")
+        content = request.query_params
+    recipe_name = content.get('recipe_name')
+    if not recipe_name:
+        raise HTTPException(status_code=400, detail="No recipe name provided")
+    entry = registry.resolve(content, request.headers)
+
+    started = time.perf_counter()
+    snapshot, plan, details, query_vector, path = await match_recipe(recipe_name, entry)
+    prompt_inputs = plan.inputs
+    match_ms = round((time.perf_counter() - started) * 1000, 1)
+    closest_task = prompt_inputs["closest_task"]
+    fingerprint = snapshot.journey_fingerprint(closest_task)
+    cached, cache_status = None, "off"
+    if response_cache is not None:
+        cached, cache_status = await response_cache.alookup(prompt_inputs, entry.name, closest_task, fingerprint, query_vector)
+
+    async def events():
+        yield sse_event("match", {"details": details, "match_path": path, "catalog": entry.name, "catalog_age": snapshot.age(), "bundle_version": snapshot.bundle_version})
+        completion = []
+        first_token_ms = None
+        if cached is not None:
+            # A cached answer is sent as a single token event
+            first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+            completion.append(cached)
+            yield sse_event("token", {"text": cached})
+        else:
+            llm_started = time.perf_counter()
+            try:
+                async for chunk in astream("llm", get_llm_chain().llm.astream(plan.text), LLM_TIMEOUT):
+                    if not chunk.content:
+                        continue
+                    if first_token_ms is None:
+                        first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+                    completion.append(chunk.content)
+                    yield sse_event("token", {"text": chunk.content})
+                plan.record(''.join(completion))
+                if response_cache is not None:
+                    await response_cache.astore(prompt_inputs, entry.name, closest_task, fingerprint, ''.join(completion), query_vector)
+            except Exception as e:
+                count_upstream_error("llm")
+                reason = unavailable_reason(e)
+                count_degraded("llm", reason)
+                yield sse_event("error", {"detail": f"Generation failed: {e}", "unavailable": reason})
+            record_stage("llm", time.perf_counter() - llm_started)
+        yield sse_event("done", {
+            "timing": {
+                "match_ms": match_ms,
+                "first_token_ms": first_token_ms,
+                "total_ms": round((time.perf_counter() - started) * 1000, 1)
+            },
+            "usage": plan.usage(''.join(completion) if completion else None),
+            "response_cache": cache_status
+        })
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post('/refresh_catalog')
+async def refresh_catalog(request: Request):
+    entry = registry.resolve(request.query_params, request.headers)
+    try:
+        snapshot = await entry.catalog.arefresh()
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Catalog refresh failed: {e}")
+    await registry.aindex(entry, snapshot)
+    return JSONResponse({"refreshed": True, "catalog": entry.name, "catalog_age": snapshot.age()})
+
+@app.get('/cache_stats')
+async def cache_stats():
+    return JSONResponse({
+        "embeddings": embeddings.stats(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "journey_index": journey_index.current.stats() if journey_index.current is not None else None
+    })
+
+def load_models():
+    startup.preload('langchain.chains', 'langchain.prompts', 'tiktoken')
+    with startup.phase("llm"):
+        get_llm_chain()
+    with startup.phase("tokenizer"):
+        get_encoding()
+
+async def warm_up():
+    # The sheet fetch and index load overlap with importing langchain in the executor
+    async def load_index():
+        with startup.phase("catalog"):
+            snapshot = await catalog.aget()
+        with startup.phase("index"):
+            await registry.aindex(registry.default, snapshot)
+    await asyncio.gather(load_index(), run_blocking(load_models))
+
+startup.install_fastapi(app, warm_up)
+methods_api.install_fastapi(app, registry)
+catalog_registry.install_fastapi(app, registry)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_http_client()
 
 if __name__ == "__main__":
     import uvicorn
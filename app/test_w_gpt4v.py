@@ -1,9 +1,11 @@
 import base64
+import hashlib
+import time
 import streamlit as st
 from dotenv import load_dotenv
 import os
 import requests
-from PIL import Image
+from PIL import Image, ImageOps
 import io
 import pyperclip
 import json
@@ -12,12 +14,61 @@ load_dotenv()
 
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
+GPT4V_MODEL = os.getenv("GPT4V_MODEL", "gpt-4-vision-preview")
+GPT4V_MAX_TOKENS = int(os.getenv("GPT4V_MAX_TOKENS", "1400"))
+# high: fit in 2048x2048, then shortest side 768 (what the model tiles at high detail)
+# low: fit in 512x512, one tile
+GPT4V_IMAGE_DETAIL = os.getenv("GPT4V_IMAGE_DETAIL", "high")
+GPT4V_JPEG_QUALITY = int(os.getenv("GPT4V_JPEG_QUALITY", "85"))
+# Seconds between re-renders of the code block while tokens stream in
+GPT4V_RENDER_INTERVAL = float(os.getenv("GPT4V_RENDER_INTERVAL", "0.1"))
+GPT4V_TIMEOUT = float(os.getenv("GPT4V_TIMEOUT", "120"))
+
+def target_size(width, height, detail=GPT4V_IMAGE_DETAIL):
+    # Largest size the model looks at for this detail level; images are never upscaled
+    if detail == 'low':
+        scale = min(1.0, 512 / max(width, height))
+    else:
+        scale = min(1.0, 2048 / max(width, height))
+        if min(width, height) * scale > 768:
+            scale *= 768 / (min(width, height) * scale)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
 # Function to encode the image
-# @st.cache_data
-def encode_image(image):
+# Cached by content digest, so reruns with the same upload skip decoding and resizing;
+# the raw bytes (underscore argument) are not hashed by Streamlit
+@st.cache_data(max_entries=32)
+def encode_image(digest, _data, detail=GPT4V_IMAGE_DETAIL, quality=GPT4V_JPEG_QUALITY):
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(_data)))
+    original_size = image.size
+    if image.mode != 'RGB':
+        # JPEG has no alpha channel; transparent areas become white
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+        image = background
+    size = target_size(*image.size, detail=detail)
+    if size != image.size:
+        image = image.resize(size, Image.LANCZOS)
     buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+    image.save(buffered, format="JPEG", quality=quality, optimize=True)
+    encoded = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    return encoded, {"original_size": original_size, "size": size, "upload_bytes": len(_data), "payload_bytes": len(encoded)}
+
+def stream_completion(response):
+    # Yields the content deltas of a chat completions Server-Sent Events stream
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            return
+        chunk = json.loads(data)
+        if 'error' in chunk:
+            raise RuntimeError(chunk['error'].get('message', chunk['error']))
+        for choice in chunk.get('choices', []):
+            content = choice.get('delta', {}).get('content')
+            if content:
+                yield content
 
 # Placeholder code
 placeholder_code = """
@@ -51,10 +102,14 @@ prompt = "Create a React component using Material-UI that resembles the uploaded
 user_input = st.text_area("Describe your component", value=prompt)
 
 if image_file is not None:
-    # Open the image file
-    image = Image.open(image_file)
-    # Encode the image
-    base64_image = encode_image(image)
+    # Encode the image, reusing the cached payload when the upload has not changed
+    image_data = image_file.getvalue()
+    base64_image, image_info = encode_image(hashlib.sha256(image_data).hexdigest(), image_data)
+    st.sidebar.image(image_data)
+    st.sidebar.caption(
+        f"{image_info['original_size'][0]}x{image_info['original_size'][1]} → {image_info['size'][0]}x{image_info['size'][1]}, "
+        f"{image_info['upload_bytes'] // 1024} KB upload, {image_info['payload_bytes'] // 1024} KB sent"
+    )
 
     headers = {
         "Content-Type": "application/json",
@@ -62,7 +117,7 @@ if image_file is not None:
     }
 
     payload = {
-        "model": "gpt-4-vision-preview",
+        "model": GPT4V_MODEL,
         "messages": [
           {
             "role": "user",
@@ -74,36 +129,49 @@ if image_file is not None:
               {
                 "type": "image_url",
                 "image_url": {
-                  "url": f"data:image/jpeg;base64,{base64_image}"
+                  "url": f"data:image/jpeg;base64,{base64_image}",
+                  "detail": GPT4V_IMAGE_DETAIL
                 }
               }
             ]
           }
         ],
-        "max_tokens": 1400
+        "max_tokens": GPT4V_MAX_TOKENS,
+        "stream": True
     }
-  
-    # Initialize a variable to track if the button has been clicked
-    # This variable should be set outside of the if block to persist its state
-   
+
     if st.sidebar.button('Generate React Component'):
-        
+        output = st.empty()
+        status = st.empty()
+        generated_code = ""
+        started = time.perf_counter()
+        first_token = None
+        failed = False
         with st.spinner('Generating...'):
-            response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload, stream=True)
-            if response.status_code == 200:
-                response_text = response.text.strip()
-                if response_text:
-                    try:
-                        json_response = json.loads(response_text)
-                        # Process the JSON response
-                        generated_code = json_response['choices'][0]['message']['content']
-                        st.code(generated_code, language='python')
-                    except json.JSONDecodeError as e:
-                        st.error(f"JSON decode error: {e}")
-                else:
-                    st.error("Received an empty response.")
-            else:
-                st.error(f"Failed to generate code: {response.status_code} - {response.text}")
-
-    # ... rest of the code ...
-
+            try:
+                with requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload, stream=True, timeout=GPT4V_TIMEOUT) as response:
+                    if response.status_code != 200:
+                        failed = True
+                        st.error(f"Failed to generate code: {response.status_code} - {response.text}")
+                    else:
+                        rendered = 0.0
+                        for content in stream_completion(response):
+                            if first_token is None:
+                                first_token = time.perf_counter() - started
+                            generated_code += content
+                            # Render as tokens arrive, at most every GPT4V_RENDER_INTERVAL seconds
+                            if time.perf_counter() - rendered >= GPT4V_RENDER_INTERVAL:
+                                output.code(generated_code, language='javascript')
+                                rendered = time.perf_counter()
+            except (requests.RequestException, RuntimeError, json.JSONDecodeError) as e:
+                failed = True
+                st.error(f"Generation failed: {e}")
+        if generated_code:
+            output.code(generated_code, language='javascript')
+            st.session_state['generated_code'] = generated_code
+            status.caption(f"First token after {first_token:.1f}s, done after {time.perf_counter() - started:.1f}s")
+        elif not failed:
+            status.warning("Received an empty response.")
+    elif 'generated_code' in st.session_state:
+        # Keep the last result on screen across reruns
+        st.code(st.session_state['generated_code'], language='javascript')
@@ -0,0 +1,232 @@
+import os
+import threading
+import weakref
+
+import numpy as np
+
+from async_utils import run_blocking
+from journey_index import JourneyIndexStore, normalize
+from metrics import stage
+
+# Vector store used for journey matching: faiss (the persisted, incrementally updated
+# journey index), faiss-flat, faiss-hnsw, numpy or chroma. Unset, each service keeps
+# its own default.
+VECTOR_STORE = os.getenv("VECTOR_STORE", "")
+VECTOR_HNSW_M = int(os.getenv("VECTOR_HNSW_M", "32"))
+VECTOR_HNSW_EF_CONSTRUCTION = int(os.getenv("VECTOR_HNSW_EF_CONSTRUCTION", "80"))
+VECTOR_HNSW_EF_SEARCH = int(os.getenv("VECTOR_HNSW_EF_SEARCH", "64"))
+
+# Chroma rejects larger add() calls
+CHROMA_ADD_BATCH = 5000
+
+
+class VectorStore:
+    # In-memory journey vectors behind one interface. Vectors are L2-normalized, so every
+    # store scores by cosine similarity and results are comparable across stores.
+
+    kind = None
+
+    def __init__(self, names, vectors):
+        self.names = list(names)
+        vectors = normalize(vectors)
+        self.dim = vectors.shape[1] if len(vectors) else 0
+        self._build(vectors)
+
+    def _build(self, vectors):
+        raise NotImplementedError
+
+    def _search(self, queries, k):
+        # (scores, positions) arrays of shape (len(queries), k); position -1 pads
+        raise NotImplementedError
+
+    def nbytes(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        return len(self.names)
+
+    def search_many(self, vectors, k=1):
+        if not self.names:
+            return [[] for _ in range(len(vectors))]
+        scores, positions = self._search(normalize(vectors), min(k, len(self.names)))
+        return [
+            [(self.names[p], float(score)) for score, p in zip(row_scores, row_positions) if p != -1]
+            for row_scores, row_positions in zip(scores, positions)
+        ]
+
+    def search(self, vector, k=1):
+        return self.search_many([vector], k)[0]
+
+    def stats(self):
+        return {
+            "journeys": len(self.names),
+            "storage": self.kind,
+            "bytes_per_vector": round(self.nbytes() / len(self.names), 1) if self.names else None,
+        }
+
+
+class NumpyStore(VectorStore):
+    # Brute force: one matrix product per query batch
+    kind = 'numpy'
+
+    def _build(self, vectors):
+        self.matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+
+    def _search(self, queries, k):
+        scores = queries @ self.matrix.T
+        if k < scores.shape[1]:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+    def nbytes(self):
+        return self.matrix.nbytes
+
+
+class FaissFlatStore(VectorStore):
+    kind = 'faiss-flat'
+
+    def _build(self, vectors):
+        import faiss
+        self.index = faiss.IndexFlatIP(self.dim or 1)
+        if len(vectors):
+            self.index.add(vectors)
+
+    def _search(self, queries, k):
+        return self.index.search(queries, k)
+
+    def nbytes(self):
+        return self.index.ntotal * self.index.d * 4
+
+
+class FaissHNSWStore(VectorStore):
+    # Approximate graph search; VECTOR_HNSW_EF_SEARCH trades recall for latency
+    kind = 'faiss-hnsw'
+
+    def _build(self, vectors):
+        import faiss
+        self.index = faiss.IndexHNSWFlat(self.dim or 1, VECTOR_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        self.index.hnsw.efConstruction = VECTOR_HNSW_EF_CONSTRUCTION
+        self.index.hnsw.efSearch = VECTOR_HNSW_EF_SEARCH
+        if len(vectors):
+            self.index.add(vectors)
+
+    def _search(self, queries, k):
+        return self.index.search(queries, k)
+
+    def nbytes(self):
+        import faiss
+        return len(faiss.serialize_index(self.index))
+
+
+class ChromaStore(VectorStore):
+    # In-process Chroma collection with cosine distance; needs the chromadb package. The
+    # client is shared by the process, so the collection is deleted once the store is no
+    # longer referenced: after a rebuild or an unload, when the last search using it ends.
+    kind = 'chroma'
+
+    def _build(self, vectors):
+        import uuid
+
+        import chromadb
+        self.client = chromadb.EphemeralClient()
+        name = f"journeys-{uuid.uuid4().hex}"
+        self.collection = self.client.create_collection(name, metadata={"hnsw:space": "cosine"})
+        weakref.finalize(self, _delete_collection, self.client, name)
+        for start in range(0, len(vectors), CHROMA_ADD_BATCH):
+            batch = vectors[start:start + CHROMA_ADD_BATCH]
+            self.collection.add(ids=[str(i) for i in range(start, start + len(batch))], embeddings=batch.tolist())
+
+    def _search(self, queries, k):
+        result = self.collection.query(query_embeddings=queries.tolist(), n_results=k, include=["distances"])
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        positions = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, (ids, distances) in enumerate(zip(result['ids'], result['distances'])):
+            positions[row, :len(ids)] = [int(i) for i in ids]
+            scores[row, :len(ids)] = 1 - np.asarray(distances, dtype=np.float32)
+        return scores, positions
+
+    def nbytes(self):
+        # Raw vectors only; Chroma's own index and metadata come on top
+        return len(self.names) * self.dim * 4
+
+
+def _delete_collection(client, name):
+    try:
+        client.delete_collection(name)
+    except Exception:
+        pass
+
+
+VECTOR_STORES = {store.kind: store for store in (NumpyStore, FaissFlatStore, FaissHNSWStore, ChromaStore)}
+
+
+def build_store(kind, names, vectors):
+    if kind not in VECTOR_STORES:
+        raise ValueError(f"Unknown vector store {kind!r}; expected one of {', '.join(sorted(VECTOR_STORES))}")
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if not len(names):
+        vectors = np.zeros((0, vectors.shape[-1] if vectors.ndim == 2 else 1), dtype=np.float32)
+    return VECTOR_STORES[kind](names, vectors)
+
+
+class VectorMatcher:
+    # Keeps a store of the given kind built for the current catalog snapshot. Journey
+    # vectors come from the embedding cache, so a rebuild after a catalog refresh only
+    # embeds new names. Has the same get/aget/sync interface as JourneyIndexStore.
+
+    def __init__(self, embeddings, kind):
+        if kind not in VECTOR_STORES:
+            raise ValueError(f"Unknown vector store {kind!r}; expected one of {', '.join(sorted(VECTOR_STORES))}")
+        self.embeddings = embeddings
+        self.kind = kind
+        self.current = None
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def seed(self, snapshot, journey_index):
+        # Bundles carry a FAISS index; other stores build from the cached vectors
+        pass
+
+    def unload(self):
+        # The next get() rebuilds the store from the embedding cache
+        with self._lock:
+            self._snapshot = None
+            self.current = None
+
+    def sync(self, snapshot):
+        with self._lock:
+            if self._snapshot is not snapshot or self.current is None:
+                names = snapshot.journey_names
+                vectors = self.embeddings.embed_documents(names, bulk=True) if names else []
+                with stage("index_build"):
+                    self.current = build_store(self.kind, names, vectors)
+                self._snapshot = snapshot
+            return self.current
+
+    async def async_sync(self, snapshot):
+        if self._snapshot is snapshot and self.current is not None:
+            return self.current
+        # Cached vectors are read in the executor; misses are embedded there too
+        return await run_blocking(self.sync, snapshot)
+
+    def get(self, snapshot):
+        current = self.current
+        if current is not None and self._snapshot is snapshot:
+            return current
+        return self.sync(snapshot)
+
+    async def aget(self, snapshot):
+        return await self.async_sync(snapshot)
+
+
+def journey_index_from_env(path, embeddings, default='faiss'):
+    # The persisted FAISS journey index, or a VectorMatcher for any other store
+    kind = VECTOR_STORE or default
+    if kind == 'faiss':
+        return JourneyIndexStore(path, embeddings)
+    return VectorMatcher(embeddings, kind)
+
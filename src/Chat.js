@@ -4,6 +4,28 @@ import ShuffleIcon from '@mui/icons-material/Shuffle';
 import DeleteIcon from '@mui/icons-material/Delete';
 import ChatInterface from './ChatInterface';
 
+// When set, methods come from the API's GET /methods instead of the raw spreadsheet
+const API_URL = process.env.REACT_APP_API_URL;
+const SHEET_URL = 'https://gs.jasonaa.me/?url=https://docs.google.com/spreadsheets/d/e/2PACX-1vSmp889ksBKKVVwpaxhlIzpDzXNOWjnszEXBP7SC5AyoebSIBFuX5qrcwwv6ud4RCYw2t_BZRhGLT0u/pubhtml?gid=1980586524&single=true';
+
+// Methods shown per page load
+const METHOD_SAMPLE = 5;
+
+// Fetches a random sample of methods from the API, a few KB instead of the whole table,
+// as sheet-like rows: alternatives go three per row into 'Alt 1'..'Alt 3'
+function fetchMethodRows() {
+  return fetch(`${API_URL}/methods?fields=method,alternatives&sample=${METHOD_SAMPLE}`)
+    .then(response => response.json())
+    .then(page => page.methods.flatMap(item => {
+      const rows = [];
+      for (let i = 0; i < Math.max(item.alternatives.length, 1); i += 3) {
+        const [alt1, alt2, alt3] = item.alternatives.slice(i, i + 3);
+        rows.push({ Uniques: item.method, 'Alt 1': alt1, 'Alt 2': alt2, 'Alt 3': alt3 });
+      }
+      return rows;
+    }));
+}
+
 function Chat() {
   const [topics, setTopics] = useState([]);
   const [showDetails, setShowDetails] = useState(false);
@@ -13,17 +35,19 @@ function Chat() {
   const [shuffleCount, setShuffleCount] = useState({});
 
   useEffect(() => {
-    const cachedData = sessionStorage.getItem('cachedData');
+    // The API samples fresh methods on every load; only the full sheet is worth caching
+    const cachedData = API_URL ? null : sessionStorage.getItem('cachedData');
     if (cachedData) {
       const parsedData = JSON.parse(cachedData);
       setData(parsedData);
       processFetchedData(parsedData); // Process the cached data to extract methods and alternatives
     } else {
       // Fetching data from the API and processing it
-      fetch('https://gs.jasonaa.me/?url=https://docs.google.com/spreadsheets/d/e/2PACX-1vSmp889ksBKKVVwpaxhlIzpDzXNOWjnszEXBP7SC5AyoebSIBFuX5qrcwwv6ud4RCYw2t_BZRhGLT0u/pubhtml?gid=1980586524&single=true')
-        .then(response => response.json())
+      (API_URL ? fetchMethodRows() : fetch(SHEET_URL).then(response => response.json()))
         .then(fetchedData => {
-          sessionStorage.setItem('cachedData', JSON.stringify(fetchedData));
+          if (!API_URL) {
+            sessionStorage.setItem('cachedData', JSON.stringify(fetchedData));
+          }
           setData(fetchedData);
           processFetchedData(fetchedData); // Process the fetched data to extract methods and alternatives
         })
@@ -37,14 +61,15 @@ function Chat() {
   const processFetchedData = (fetchedData) => {
     if (fetchedData && Array.isArray(fetchedData)) {
       // Extract unique methods and shuffle them
-      let uniqueMethods = fetchedData.map(item => item.Uniques).filter(unique => unique);
+      // A method spans several rows when it has more than three alternatives
+      let uniqueMethods = [...new Set(fetchedData.map(item => item.Uniques).filter(unique => unique))];
       for (let i = uniqueMethods.length - 1; i > 0; i--) {
         const j = Math.floor(Math.random() * (i + 1));
         [uniqueMethods[i], uniqueMethods[j]] = [uniqueMethods[j], uniqueMethods[i]];
       }
   
       // Only pull in 5 random Unique key values
-      uniqueMethods = uniqueMethods.slice(0, 5);
+      uniqueMethods = uniqueMethods.slice(0, METHOD_SAMPLE);
   
       // Map each unique method to its alternatives
       const altsMapping = uniqueMethods.reduce((acc, unique) => {
@@ -164,8 +189,8 @@ function Chat() {
             </Button>
           </div>
         ))}
-       {methods && methods.map((method, index) => (
-        <React.Fragment key={index}>
+       {methods && methods.map((method) => (
+        <React.Fragment key={method}>
           <Divider style={{ backgroundColor: 'grey', marginTop: '10px' }} />
           <Accordion>
           <AccordionSummary